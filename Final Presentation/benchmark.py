@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from histogram_intersection import get_histogram_distance, get_histogram_distance_matrix
+from feature_store import load_feature_store, open_feature_store, get_store_fingerprint
+from exhaustive import search_exhaustive, select_results
+from vp_tree import build_vptree_from_matrix, search_vptree, knn_search_vptree
+from quantized_features import quantize_histograms, search_exhaustive_quantized
+from sparse_histograms import choose_color_matrix
+from bound_cascade import BoundCascade, search_exhaustive_cascade
+from inverted_index import build_inverted_index, search_inverted_index
+from pivot_table import build_pivot_table, search_pivot_table
+from weighted_l1 import build_weighted_l1_index, search_weighted_l1_index
+from ivf_index import build_ivf_index, search_ivf_index
+
+'''
+Unified retrieval benchmark for every search engine on the same features
+    - every engine in ENGINES is built over the same subset of the feature store and answers the same queries
+        - register_engine(name, build, search, stats=None) adds an engine
+            - build(names, color_matrix, lbp_matrix) returns the engine's index
+            - search(index, query_feature, tau, k) returns (fetched_relevant_images, comparisons) like the server's methods
+            - stats(index), if given, returns extra counters recorded after the queries (e.g. the cascade's stage survivors)
+    - size sweep: each engine runs on random subsets of the collection (e.g. 1/4, 1/2 and all images)
+    - radius mode searches within tau, knn mode for the k nearest images
+    - per engine, size and mode it reports
+        - build time
+        - query latency (mean, p50, p95, p99) over repeats, after warmup queries
+        - distance evaluations per query
+        - recall against exact results from the full distance matrix of the queries
+        - peak RSS of the process (and how much the build added), each engine runs in its own fresh process by default
+        - per-stage survivors for engines with a stats hook (the bound cascade)
+        - posting entries read per query for the inverted file, whose distance evaluations leave them out
+    - writes everything to a JSON file (benchmark_results.json) so runs can be compared for regressions
+    - usage: python benchmark.py [--engines exhaustive vp_tree] [--sizes 100 400] [--queries 100] [--output results.json]
+'''
+
+# name -> (build, search, stats)
+ENGINES = {}
+
+def register_engine(name, build, search, stats=None):
+    ENGINES[name] = (build, search, stats)
+
+# the original per-pair loop, one get_histogram_distance call per image
+def build_pairwise(names, color_matrix, lbp_matrix):
+    return names, color_matrix, lbp_matrix
+
+def search_pairwise(index, query_feature, tau, k):
+    names, color_matrix, lbp_matrix = index
+    distances = np.array([get_histogram_distance(query_feature[0], color_matrix[i], query_feature[1], lbp_matrix[i], a=0.2, b=0.8)
+                          for i in range(len(names))])
+    return select_results(names, distances, tau, k)
+
+def build_exhaustive(names, color_matrix, lbp_matrix):
+    return names, color_matrix, lbp_matrix
+
+def search_exhaustive_engine(index, query_feature, tau, k):
+    names, color_matrix, lbp_matrix = index
+    return search_exhaustive(names, color_matrix, lbp_matrix, query_feature, tau, k)
+
+# color rows in sparse (CSR) form, whatever their density (search filters on them and rescores on dense rows)
+def build_exhaustive_sparse(names, color_matrix, lbp_matrix):
+    return names, choose_color_matrix(color_matrix, sparse=True), lbp_matrix
+
+# sparse=True stores the tree's color rows in sparse form, None lets the tree pick
+def vptree_builder(leaf_size, sparse=False):
+    def build(names, color_matrix, lbp_matrix):
+        return build_vptree_from_matrix(names, color_matrix, lbp_matrix, leaf_size=leaf_size, seed=0, sparse=sparse)
+    return build
+
+def search_vptree_engine(tree, query_feature, tau, k):
+    if k is None:
+        return search_vptree(tree, query_feature, tau)
+    return knn_search_vptree(tree, query_feature, k, tau=tau)
+
+# lower-bound filter cascade in front of the full intersection, alone or in the VP tree's leaves
+def build_exhaustive_cascade(names, color_matrix, lbp_matrix):
+    return names, BoundCascade(color_matrix, lbp_matrix)
+
+def search_exhaustive_cascade_engine(index, query_feature, tau, k):
+    names, cascade = index
+    return search_exhaustive_cascade(names, cascade, query_feature, tau, k)
+
+# postings of every color bin, read largest weights first with early termination
+def build_inverted_file(names, color_matrix, lbp_matrix):
+    return build_inverted_index(names, color_matrix, lbp_matrix)
+
+def search_inverted_file(index, query_feature, tau, k):
+    return search_inverted_index(index, query_feature, tau, k)
+
+# distances to n_pivots pivots per image, triangle-inequality filtering before exact scoring
+def pivot_table_builder(n_pivots):
+    def build(names, color_matrix, lbp_matrix):
+        return build_pivot_table(names, color_matrix, lbp_matrix, n_pivots=n_pivots, seed=0)
+    return build
+
+def search_pivot_table_engine(index, query_feature, tau, k):
+    return search_pivot_table(index, query_feature, tau, k)
+
+# standard L1 indexes over the [a * color_hist, b * lbp_hist] embedding, candidates rescored exactly
+def weighted_l1_builder(backend):
+    def build(names, color_matrix, lbp_matrix):
+        return build_weighted_l1_index(names, color_matrix, lbp_matrix, backend=backend)
+    return build
+
+def search_weighted_l1_engine(index, query_feature, tau, k):
+    return search_weighted_l1_index(index, query_feature, tau, k)
+
+# k-means lists scanned closest first, exact (nprobe=None) or only the nprobe closest lists
+def build_ivf(names, color_matrix, lbp_matrix):
+    return build_ivf_index(names, color_matrix, lbp_matrix, seed=0)
+
+def ivf_searcher(nprobe=None):
+    def search(index, query_feature, tau, k):
+        return search_ivf_index(index, query_feature, tau, k, nprobe=nprobe)
+    return search
+
+def cascade_tree_builder(leaf_size):
+    def build(names, color_matrix, lbp_matrix):
+        return build_vptree_from_matrix(names, color_matrix, lbp_matrix, leaf_size=leaf_size, seed=0, bound_cascade=True)
+    return build
+
+# uint16 fixed-point rows with integer intersection, alone or with exact float rescoring of the candidates
+def build_quantized(names, color_matrix, lbp_matrix):
+    return names, quantize_histograms(color_matrix), quantize_histograms(lbp_matrix), color_matrix, lbp_matrix
+
+def search_quantized(index, query_feature, tau, k):
+    names, color_quantized, lbp_quantized, _, _ = index
+    return search_exhaustive_quantized(names, color_quantized, lbp_quantized, query_feature, tau, k)
+
+def search_quantized_exact(index, query_feature, tau, k):
+    names, color_quantized, lbp_quantized, color_matrix, lbp_matrix = index
+    return search_exhaustive_quantized(names, color_quantized, lbp_quantized, query_feature, tau, k, exact_matrices=(color_matrix, lbp_matrix))
+
+register_engine("pairwise", build_pairwise, search_pairwise)
+register_engine("exhaustive", build_exhaustive, search_exhaustive_engine)
+register_engine("vp_tree", vptree_builder(1), search_vptree_engine)
+register_engine("vp_tree_leaf8", vptree_builder(8), search_vptree_engine)
+register_engine("exhaustive_sparse", build_exhaustive_sparse, search_exhaustive_engine)
+register_engine("vp_tree_leaf8_sparse", vptree_builder(8, sparse=True), search_vptree_engine)
+register_engine("exhaustive_cascade", build_exhaustive_cascade, search_exhaustive_cascade_engine, stats=lambda index: index[1].stats())
+register_engine("vp_tree_leaf8_cascade", cascade_tree_builder(8), search_vptree_engine, stats=lambda tree: tree.cascade.stats())
+register_engine("inverted_file", build_inverted_file, search_inverted_file, stats=lambda index: index.stats())
+register_engine("pivot_table", pivot_table_builder(16), search_pivot_table_engine)
+register_engine("pivot_table_p32", pivot_table_builder(32), search_pivot_table_engine)
+register_engine("ball_tree_l1", weighted_l1_builder("ball_tree"), search_weighted_l1_engine)
+register_engine("cdist_l1", weighted_l1_builder("cdist"), search_weighted_l1_engine)
+register_engine("annoy_l1", weighted_l1_builder("annoy"), search_weighted_l1_engine)
+register_engine("ivf", build_ivf, ivf_searcher())
+register_engine("ivf_nprobe1", build_ivf, ivf_searcher(1))
+register_engine("ivf_nprobe3", build_ivf, ivf_searcher(3))
+register_engine("exhaustive_q16", build_quantized, search_quantized)
+register_engine("exhaustive_q16_exact", build_quantized, search_quantized_exact)
+
+# peak resident set size of this process in MB (None where the resource module is unavailable)
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# builds one engine over the given store rows and times its queries
+#   - returns latencies, comparisons and the names fetched for every query (from its first repeat)
+def run_engine(engine_name, store_dir, rows, query_rows, tau, k, warmup, repeats):
+    build, search, stats = ENGINES[engine_name]
+    image_files, color_store, lbp_store = open_feature_store(store_dir)
+    names = [image_files[row] for row in rows]
+    color_matrix = np.ascontiguousarray(color_store[rows])
+    lbp_matrix = np.ascontiguousarray(lbp_store[rows])
+    query_features = [(np.array(color_store[row]), np.array(lbp_store[row])) for row in query_rows]
+    rss_before = get_peak_rss_mb()
+
+    start_time = time.perf_counter()
+    index = build(names, color_matrix, lbp_matrix)
+    build_time = time.perf_counter() - start_time
+    rss_after = get_peak_rss_mb()
+
+    for query_feature in query_features[:warmup]:
+        search(index, query_feature, tau, k)
+
+    latencies = []
+    comparisons = []
+    fetched = []
+    for query_feature in query_features:
+        for repeat in range(repeats):
+            start_time = time.perf_counter()
+            fetched_relevant_images, query_comparisons = search(index, query_feature, tau, k)
+            latencies.append(time.perf_counter() - start_time)
+            if repeat == 0:
+                comparisons.append(query_comparisons)
+                fetched.append([name for name, _ in fetched_relevant_images])
+
+    return {
+        "build_time": build_time,
+        "latencies": latencies,
+        "comparisons": comparisons,
+        "fetched": fetched,
+        "build_rss_mb": rss_after - rss_before if rss_before is not None else None,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "stats": stats(index) if stats is not None else None,
+    }
+
+# recall of every query against the exact distances of its row
+#   - radius mode: fraction of the images within tau that were fetched
+#   - knn mode: fraction of the k slots filled with an image no farther than the exact k-th nearest
+def get_recall(fetched, exact_distances, name_to_pos, tau, k):
+    recalls = []
+    for names, distances in zip(fetched, exact_distances):
+        positions = np.array([name_to_pos[name] for name in names], dtype=np.int64)
+        if k is None:
+            relevant = int(np.count_nonzero(distances <= tau))
+            found = int(np.count_nonzero(distances[positions] <= tau)) if len(positions) else 0
+        else:
+            within = distances if tau is None else distances[distances <= tau]
+            relevant = min(k, len(within))
+            kth = np.partition(within, relevant - 1)[relevant - 1] if relevant > 0 else 0.0
+            found = min(relevant, int(np.count_nonzero(distances[positions] <= kth))) if len(positions) else 0
+        recalls.append(found / relevant if relevant > 0 else 1.0)
+    return recalls
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+# fraction of the candidates surviving each cascade stage (counted over warmup and repeats too), empty for other engines
+def format_stage_survivors(stats):
+    if not stats or not stats.get("candidates"):
+        return ""
+    stages = [stage for stage in stats if stage not in ("queries", "candidates")]
+    return " survivors=" + "/".join(f"{stats[stage] / stats['candidates']:.2f}" for stage in stages) + f" ({'/'.join(stages)})"
+
+# posting entries read per query, for engines that read postings lists (the inverted file)
+def format_postings(stats):
+    if not stats or not stats.get("queries") or "postings" not in stats:
+        return ""
+    return f" postings/query={stats['postings'] / stats['queries']:.1f}"
+
+def run_isolated(isolate, *args):
+    if not isolate:
+        return run_engine(*args)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_engine, *args).result()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every search engine on the same features")
+    parser.add_argument("--images", default="images/segmented", help="image directory of the feature store")
+    parser.add_argument("--store", default="features", help="feature store directory")
+    parser.add_argument("--no-update", action="store_true", help="use the feature store as-is without scanning --images")
+    parser.add_argument("--engines", nargs="+", default=sorted(ENGINES), choices=sorted(ENGINES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=None, help="collection sizes (default: 1/4, 1/2 and all images)")
+    parser.add_argument("--modes", nargs="+", default=["radius", "knn"], choices=["radius", "knn"])
+    parser.add_argument("--tau", type=float, default=0.14)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--in-process", action="store_true", help="run engines in this process (faster, but peak RSS is shared)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    if not args.no_update:
+        load_feature_store(args.images, args.store)
+    image_files, color_store, lbp_store = open_feature_store(args.store)
+    n = len(image_files)
+    sizes = args.sizes or sorted({max(1, n // 4), max(1, n // 2), n})
+    sizes = [size for size in sizes if 0 < size <= n]
+
+    rng = np.random.RandomState(args.seed)
+    records = []
+    for size in sizes:
+        # same subset and queries for every engine at this size
+        rows = np.sort(rng.permutation(n)[:size])
+        query_rows = rng.choice(rows, size=min(args.queries, size), replace=False)
+        names = [image_files[row] for row in rows]
+        name_to_pos = {name: pos for pos, name in enumerate(names)}
+        exact_distances = get_histogram_distance_matrix(color_store[query_rows], color_store[rows],
+                                                        lbp_store[query_rows], lbp_store[rows], a=0.2, b=0.8)
+
+        for mode in args.modes:
+            tau = args.tau if mode == "radius" else None
+            k = args.k if mode == "knn" else None
+            for engine_name in args.engines:
+                result = run_isolated(not args.in_process, engine_name, args.store, rows, query_rows, tau, k, args.warmup, args.repeats)
+                recalls = get_recall(result["fetched"], exact_distances, name_to_pos, tau, k)
+                latency = {key: value * 1000 for key, value in summarize(result["latencies"]).items()}
+                record = {
+                    "engine": engine_name,
+                    "size": size,
+                    "mode": mode,
+                    "tau": tau,
+                    "k": k,
+                    "queries": len(query_rows),
+                    "repeats": args.repeats,
+                    "build_time_s": result["build_time"],
+                    "latency_ms": latency,
+                    "distance_evaluations": summarize(result["comparisons"]),
+                    "recall": {"mean": float(np.mean(recalls)), "min": float(np.min(recalls))},
+                    "peak_rss_mb": result["peak_rss_mb"],
+                    "build_rss_mb": result["build_rss_mb"],
+                    "engine_stats": result["stats"],
+                }
+                records.append(record)
+                print(f"{engine_name:<22} n={size:<8} {mode:<6} build={record['build_time_s']:.4f}s "
+                      f"p50={latency['p50']:.3f}ms p95={latency['p95']:.3f}ms p99={latency['p99']:.3f}ms "
+                      f"evals={record['distance_evaluations']['mean']:.1f} recall={record['recall']['mean']:.4f}"
+                      + (f" rss={record['peak_rss_mb']:.1f}MB" if record["peak_rss_mb"] is not None else "")
+                      + format_stage_survivors(result["stats"]) + format_postings(result["stats"]))
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__, "cpus": os.cpu_count()},
+        "store": {"dir": args.store, "images": n, "fingerprint": get_store_fingerprint(args.store)},
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": records,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Wrote {len(records)} results to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import time
+
+from feature_store import load_feature_store, get_store_fingerprint
+from vp_tree import build_vptree_from_matrix, save_vptree, load_vptree
+
+'''
+Script to build the VP tree index offline and save it to disk
+    - loads (or incrementally updates) the feature store for "images/segmented"
+    - builds a seeded VP tree so the result is reproducible
+    - saves the tree to "indexes/vptree", tagged with the feature store fingerprint
+    - copy "features" and "indexes" into interface/backend to have the server load them at startup
+        - the server rebuilds the tree itself if the saved one does not match its features
+'''
+
+def main():
+    segmented_images = "images/segmented"
+    index_dir = "indexes/vptree"
+
+    # should match VPTREE_LEAF_SIZE / VPTREE_SEED in interface/backend/app.py
+    leaf_size = 8
+    seed = 0
+
+    segmented_image_files, color_matrix, lbp_matrix = load_feature_store(segmented_images)
+    fingerprint = get_store_fingerprint("features")
+
+    existing = load_vptree(index_dir, fingerprint=fingerprint)
+    if existing is not None and existing.leaf_size == leaf_size and existing.seed == seed:
+        print(f"VP tree index in {index_dir} is up to date ({len(existing)} images)")
+    else:
+        start_time = time.perf_counter()
+        vptree = build_vptree_from_matrix(segmented_image_files, color_matrix, lbp_matrix, leaf_size=leaf_size, seed=seed)
+        end_time = time.perf_counter()
+        save_vptree(vptree, index_dir, fingerprint=fingerprint)
+        print(f"Built VP tree over {len(vptree)} images in {end_time - start_time:.4f}s, saved to {index_dir}")
+
+if __name__ == "__main__":
+    main()
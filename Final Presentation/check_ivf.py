@@ -0,0 +1,66 @@
+import sys
+
+import numpy as np
+
+from feature_store import open_feature_store
+from histogram_intersection import get_histogram_distances
+from exhaustive import search_exhaustive
+from ivf_index import build_ivf_index, search_ivf_index
+
+'''
+Script to check the IVF index (ivf_index.py) against exhaustive search
+    - nprobe=1 with k larger than the probed list: every result must come from that list at a finite distance,
+      and there must be exactly as many results as the list holds
+    - nprobe=None (exact) must return the same distances as exhaustive search, for radius and top-k queries
+    - exits with status 1 if any check fails
+    - run build_index.py first (it fills the "features" store), or set store_dir = "synthetic/features" to check a collection from generate_synthetic.py
+'''
+
+# names of the images in the list nprobe=1 scans for this query
+def get_probed_names(index, query_feature):
+    color_hist, lbp_hist = query_feature
+    centroid_distances = get_histogram_distances(color_hist, index.centroid_color, lbp_hist, index.centroid_lbp, a=index.a, b=index.b)
+    j = np.argsort(centroid_distances, kind="stable")[0]
+    return {index.names[row] for row in index.order[index.offsets[j]:index.offsets[j + 1]]}
+
+def main():
+    store_dir = "features"
+
+    # number of sampled query images, similarity radius and k for the exact checks
+    queries = 30
+    tau = 0.14
+    k = 10
+
+    image_files, color_matrix, lbp_matrix = open_feature_store(store_dir)
+    index = build_ivf_index(image_files, color_matrix, lbp_matrix, seed=0)
+    print(f"IVF index over {len(index)} images in {index.n_lists} lists")
+    query_rows = np.random.RandomState(0).choice(len(image_files), size=min(queries, len(image_files)), replace=False)
+    failures = 0
+
+    # k beyond the probed list: only that list's images come back, never unscanned ones at an infinite distance
+    for query in query_rows:
+        query_feature = (color_matrix[query], lbp_matrix[query])
+        probed = get_probed_names(index, query_feature)
+        results, _ = search_ivf_index(index, query_feature, k=len(probed) + 10, nprobe=1)
+        names = {name for name, _ in results}
+        if len(results) != len(probed) or names != probed or not all(np.isfinite(distance) for _, distance in results):
+            print(f"nprobe=1, k={len(probed) + 10}: query {image_files[query]} returned {len(results)} images, expected the {len(probed)} of its list")
+            failures += 1
+
+    # exact mode against exhaustive search
+    for query in query_rows:
+        query_feature = (color_matrix[query], lbp_matrix[query])
+        for query_tau, query_k in ((tau, None), (None, k)):
+            expected, _ = search_exhaustive(image_files, color_matrix, lbp_matrix, query_feature, query_tau, query_k)
+            results, _ = search_ivf_index(index, query_feature, tau=query_tau, k=query_k)
+            expected_distances = sorted(distance for _, distance in expected)
+            distances = sorted(distance for _, distance in results)
+            if len(distances) != len(expected_distances) or not np.allclose(distances, expected_distances, rtol=0, atol=1e-7):
+                print(f"nprobe=None, tau={query_tau}, k={query_k}: query {image_files[query]} returned {len(distances)} images, exhaustive {len(expected_distances)}")
+                failures += 1
+
+    print(f"{len(query_rows)} queries checked, {failures} failures")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+
+from feature_store import load_feature_store, open_feature_store
+from histogram_intersection import get_histogram_distances
+from quantized_features import open_quantized_store, get_quantized_distances, bytes_per_image, check_parity
+
+'''
+Script to build the compact uint16 copy of the feature store and check it against the float features
+    - quantizes "features" into color_q16.npy / lbp_q16.npy (see quantized_features.py)
+    - reports memory per image and for the whole collection, float vs uint16
+    - parity check over a sample of query images against every image
+        - max/mean distance error (and the worst-case bound), tau decisions that flip, top-k overlap
+    - times the float min-sum against the integer min-sum for one query against the whole collection
+    - set store_dir = "synthetic/features" (and update = False) to check a collection from generate_synthetic.py
+'''
+
+def main():
+    segmented_images = "images/segmented"
+    store_dir = "features"
+    update = True
+
+    # number of sampled query images, similarity radius and k for the parity check
+    queries = 100
+    tau = 0.14
+    k = 10
+
+    if update:
+        load_feature_store(segmented_images, store_dir)
+    image_files, color_matrix, lbp_matrix = open_feature_store(store_dir)
+
+    start_time = time.perf_counter()
+    _, color_quantized, lbp_quantized = open_quantized_store(store_dir)
+    end_time = time.perf_counter()
+    print(f"Quantized store of {len(image_files)} images ready in {end_time - start_time:.4f}s")
+
+    float_bytes = bytes_per_image(color_matrix, lbp_matrix)
+    quantized_bytes = bytes_per_image(color_quantized, lbp_quantized)
+    print(f"Memory per image: float {float_bytes} bytes, uint16 {quantized_bytes} bytes ({float_bytes / quantized_bytes:.2f}x smaller)")
+    print(f"Memory for the collection: float {float_bytes * len(image_files) / 2**20:.2f}MB, uint16 {quantized_bytes * len(image_files) / 2**20:.2f}MB")
+
+    query_rows = np.random.RandomState(0).choice(len(image_files), size=min(queries, len(image_files)), replace=False)
+    parity = check_parity(color_matrix, lbp_matrix, color_quantized, lbp_quantized, query_rows, tau=tau, k=k)
+    print(f"Parity over {parity['pairs']} pairs: max error {parity['max_error']:.3e} (bound {parity['error_bound']:.3e}), "
+          f"mean error {parity['mean_error']:.3e}, {parity['tau_flips']} tau={tau} decisions flipped, top-{k} overlap {parity['topk_overlap']:.4f}")
+
+    query = query_rows[0]
+    start_time = time.perf_counter()
+    for _ in range(10):
+        get_histogram_distances(color_matrix[query], color_matrix, lbp_matrix[query], lbp_matrix, a=0.2, b=0.8)
+    float_time = (time.perf_counter() - start_time) / 10
+    start_time = time.perf_counter()
+    for _ in range(10):
+        get_quantized_distances(color_quantized[query], color_quantized, lbp_quantized[query], lbp_quantized, a=0.2, b=0.8)
+    quantized_time = (time.perf_counter() - start_time) / 10
+    print(f"One query against every image: float {float_time * 1000:.3f}ms, uint16 {quantized_time * 1000:.3f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,3 @@
-import os
-
-import cv2
 import numpy as np
 from sklearn.cluster import KMeans, AgglomerativeClustering, DBSCAN
 from scipy.cluster.hierarchy import linkage
@@ -8,7 +5,7 @@ from matplotlib import pyplot as plt
 import json
 from collections import defaultdict
 
-from histogram_intersection import compute_3d_hist, compute_lbp_hist
+from feature_store import load_feature_store
 
 '''
 Clustering script to cluster similar parasites for ground truth
@@ -33,24 +30,6 @@ def combine_features(color_hist, lbp_hist, a=0.1, b=0.9):
     return np.concatenate([color_hist, lbp_hist])
 
 
-# load images
-image_dir = "images/segmented"
-image_files = [os.path.join(image_dir, f) for f in os.listdir(image_dir)]
-
-# compute features for each image
-features = []
-filenames = []
-for img_file in image_files:
-    # get histograms of image
-    image = cv2.imread(img_file)
-    color_hist = compute_3d_hist(image)
-    lbp_hist = compute_lbp_hist(image)
-
-    # concatenate into one feature vector
-    feature_vector = combine_features(color_hist, lbp_hist, a=0.2, b=0.8)
-    features.append(feature_vector)
-    filenames.append(img_file)
-
 # K-means clustering
 def kmeans_clustering(features, num_clusters):
     # use elbow method to determine optimal k
@@ -108,23 +87,40 @@ def dbscan_clustering(features, eps=0.5, min_samples=5, metric="euclidean"):
     labels = dbscan.fit_predict(features)
     return labels
 
-# kmeans clustering labels
-labels = kmeans_clustering(features, num_clusters=12)
+def main():
+    # load images
+    image_dir = "images/segmented"
+    image_files, color_matrix, lbp_matrix = load_feature_store(image_dir)
+
+    # build a combined feature vector for each image
+    features = []
+    filenames = []
+    for img_file, color_hist, lbp_hist in zip(image_files, color_matrix, lbp_matrix):
+        # concatenate into one feature vector
+        feature_vector = combine_features(color_hist, lbp_hist, a=0.2, b=0.8)
+        features.append(feature_vector)
+        filenames.append(img_file)
+
+    # kmeans clustering labels
+    labels = kmeans_clustering(features, num_clusters=12)
+
+    # agglomerative clustering labels
+    labels = agglomerative_clustering(features, method="average", metric="cosine")
 
-# agglomerative clustering labels
-labels = agglomerative_clustering(features, method="average", metric="cosine")
+    # dbscan clustering labels
+    # labels = dbscan_clustering(features, eps=0.15, min_samples=1, metric="manhattan")
 
-# dbscan clustering labels
-# labels = dbscan_clustering(features, eps=0.15, min_samples=1, metric="manhattan")
+    # adjust the above comments, num_clusters, etc functions to produce and test different clustering methods
+    clusters = defaultdict(list)
+    for img_file, label in zip(filenames, labels):
+        clusters[int(label)].append(img_file)
 
-# adjust the above comments, num_clusters, etc functions to produce and test different clustering methods
-clusters = defaultdict(list)
-for img_file, label in zip(filenames, labels):
-    clusters[int(label)].append(img_file)
+    for cluster_id, imgs in clusters.items():
+        print(f"Cluster {cluster_id}: {len(imgs)} images")
 
-for cluster_id, imgs in clusters.items():
-    print(f"Cluster {cluster_id}: {len(imgs)} images")
+    output_file = "clusters/clusters.json"
+    with open(output_file, 'w') as f:
+        json.dump({"clusters": clusters}, f, indent=4)
 
-output_file = "clusters/clusters.json"
-with open(output_file, 'w') as f:
-    json.dump({"clusters": clusters}, f, indent=4)
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,235 @@
 import os
+import sys
+import json
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-import cv2
 import numpy as np
 
-from histogram_intersection import compute_3d_hist, compute_lbp_hist, get_histogram_distance
+from histogram_intersection import get_histogram_distance_matrix
+from feature_store import load_feature_store, open_feature_store, read_store
 
 '''
 Script to compute the distance matrix for all segmented parasite images
-    - loads segmented parasite images from "images/segmented"
-    - computes color and texture histograms for each image
+    - loads color and texture histograms for the segmented parasite images from the feature store
     - computes histogram intersection distance between each pair of images
-    - outputs distance matrix as a 2D list
+        - the matrix is split into tile_size x tile_size tiles on or above the diagonal
+        - tiles are computed with the vectorized min-sum kernel across a pool of worker processes
+        - each worker writes its tile (and the mirrored tile) straight into a memory-mapped .npy file
+        - peak memory per worker is bounded by the tile size, not by the number of images
+    - outputs distance matrix to distance_matrix-<token>.npy, a new file on every update
+    - distance_matrix.json is a sidecar index mapping every row to its image file (and content hash)
+        - it also names the matrix file its rows belong to, and replacing it atomically is what commits an update,
+          so a run that dies halfway leaves the previous matrix and its index in place
+        - use load_distance_matrix to read both instead of relying on sorted(os.listdir(...)) order
+        - it checks the matrix shape against the index
+    - updates are incremental
+        - rows of deleted or changed images are dropped
+        - new (and changed) images are appended, and only their rows/columns are computed
+        - distances between unchanged images are copied over from the existing matrix
+    - run with --full to recompute the whole matrix
 '''
 
 segmented_images = "images/segmented"
-segmented_image_files = [os.path.join(segmented_images, f) for f in os.listdir(segmented_images)]
-segmented_image_files = sorted(segmented_image_files)
-
-image_features = []
-for img_file in segmented_image_files:
-    image = cv2.imread(img_file)
-    color_hist = compute_3d_hist(image)
-    lbp_hist = compute_lbp_hist(image)
-    image_features.append((color_hist, lbp_hist))
-
-distance_matrix = [[0 for _ in range(len(segmented_image_files))] for _ in range(len(segmented_image_files))]
-
-for i in range(len(segmented_image_files)):
-    for j in range(i, len(segmented_image_files)):
-        color_hist1, lbp_hist1 = image_features[i]
-        color_hist2, lbp_hist2 = image_features[j]
-        distance = get_histogram_distance(color_hist1, color_hist2, lbp_hist1, lbp_hist2, a=0.2, b=0.8)
-        distance_matrix[i][j] = distance
-        distance_matrix[j][i] = distance
-
-# save distance matrix to np file
-distance_matrix_np = np.array(distance_matrix)
-print(distance_matrix_np.max(), distance_matrix_np.min())
-np.save("distance_matrix.npy", distance_matrix_np)
-        
\ No newline at end of file
+store_dir = "features"
+output_file = "distance_matrix.npy"
+index_file = "distance_matrix.json"
+
+# tile edge length and number of worker processes - adjust for the machine
+tile_size = 256
+workers = os.cpu_count()
+
+INDEX_VERSION = 1
+# matrices no index points to, older than this, are left over from an interrupted or displaced update
+MATRIX_STALE_SECONDS = 600
+
+worker_state = {}
+
+# each worker maps the feature store and the output matrix once
+#   - rows[i] is the feature store row of matrix row i
+def init_worker(store_dir, matrix_file, rows, tile_size):
+    _, color_matrix, lbp_matrix = open_feature_store(store_dir)
+    worker_state["color_matrix"] = color_matrix
+    worker_state["lbp_matrix"] = lbp_matrix
+    worker_state["rows"] = rows
+    worker_state["distance_matrix"] = np.load(matrix_file, mmap_mode="r+")
+
+# computes the distances between matrix rows i_start:i_end and j_start:j_end, and writes both halves of the tile
+def compute_tile(tile):
+    i_start, i_end, j_start, j_end = tile
+    color_matrix = worker_state["color_matrix"]
+    lbp_matrix = worker_state["lbp_matrix"]
+    i_rows = worker_state["rows"][i_start:i_end]
+    j_rows = worker_state["rows"][j_start:j_end]
+    distance_matrix = worker_state["distance_matrix"]
+
+    distances = get_histogram_distance_matrix(color_matrix[i_rows], color_matrix[j_rows],
+                                              lbp_matrix[i_rows], lbp_matrix[j_rows], a=0.2, b=0.8)
+    distance_matrix[i_start:i_end, j_start:j_end] = distances
+    distance_matrix[j_start:j_end, i_start:i_end] = distances.T
+    distance_matrix.flush()
+    return tile
+
+# tiles covering every pair that involves at least one row in new_start:n
+#   - new_start=0 covers the whole upper triangle
+def pending_tiles(n, new_start, tile_size):
+    tiles = []
+    for i_start in range(new_start, n, tile_size):
+        i_end = min(i_start + tile_size, n)
+        # new rows against the kept rows
+        for j_start in range(0, new_start, tile_size):
+            tiles.append((i_start, i_end, j_start, min(j_start + tile_size, new_start)))
+        # new rows against each other, upper triangle only
+        for j_start in range(i_start, n, tile_size):
+            tiles.append((i_start, i_end, j_start, min(j_start + tile_size, n)))
+    return tiles
+
+def read_matrix_index(index_file):
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, "r") as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION:
+        return None
+    return index
+
+# atomically replaces the index, recording the matrix file its rows belong to
+def write_matrix_index(index_file, images, hashes, matrix_file):
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(index_file) + ".", suffix=".tmp", dir=os.path.dirname(index_file) or ".")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"version": INDEX_VERSION, "matrix_file": matrix_file, "images": images, "hashes": hashes}, f, indent=4)
+    os.replace(tmp_file, index_file)
+
+# path of the matrix an index belongs to (indexes written before it was recorded belong to output_file)
+def get_matrix_path(index, output_file):
+    if "matrix_file" not in index:
+        return output_file
+    return os.path.join(os.path.dirname(output_file), index["matrix_file"])
+
+# a new, uniquely named matrix file next to output_file
+def new_matrix_path(output_file):
+    stem, ext = os.path.splitext(os.path.basename(output_file))
+    fd, path = tempfile.mkstemp(prefix=f"{stem}-", suffix=ext, dir=os.path.dirname(output_file) or ".")
+    os.close(fd)
+    return path
+
+# the current index and its memory-mapped matrix, or (None, None) if there is no index
+def read_distance_matrix(output_file, index_file):
+    index = read_matrix_index(index_file)
+    if index is None:
+        return None, None
+    while True:
+        try:
+            distance_matrix = np.load(get_matrix_path(index, output_file), mmap_mode="r")
+            break
+        except OSError:
+            # a newer update replaced this matrix while it was being opened, open that one instead
+            latest = read_matrix_index(index_file)
+            if latest is None or get_matrix_path(latest, output_file) == get_matrix_path(index, output_file):
+                raise
+            index = latest
+    n = len(index["images"])
+    if distance_matrix.shape != (n, n):
+        raise ValueError(f"Distance matrix {get_matrix_path(index, output_file)} is {distance_matrix.shape}, but {index_file} lists {n} images")
+    return index, distance_matrix
+
+# image files in row order and the (memory-mapped) distance matrix
+def load_distance_matrix(output_file="distance_matrix.npy", index_file="distance_matrix.json"):
+    index, distance_matrix = read_distance_matrix(output_file, index_file)
+    if index is None:
+        raise FileNotFoundError(f"No distance matrix index found at {index_file}, run distance_matrix.py")
+    return index["images"], distance_matrix
+
+# swaps in the index of a finished matrix, then deletes the matrix it replaced
+def commit_distance_matrix(output_file, index_file, matrix_path, images, hashes):
+    matrix_file = os.path.basename(matrix_path)
+    previous = read_matrix_index(index_file)
+    write_matrix_index(index_file, images, hashes, matrix_file)
+    if previous is not None and os.path.basename(get_matrix_path(previous, output_file)) != matrix_file:
+        try:
+            os.remove(get_matrix_path(previous, output_file))
+        except OSError:
+            pass
+    # matrices of runs that died or were displaced by a concurrent one, old enough that no run is still writing them
+    current = read_matrix_index(index_file)
+    referenced = {matrix_file} | ({os.path.basename(get_matrix_path(current, output_file))} if current is not None else set())
+    stem, ext = os.path.splitext(os.path.basename(output_file))
+    for name in os.listdir(os.path.dirname(output_file) or "."):
+        path = os.path.join(os.path.dirname(output_file), name)
+        if name in referenced or not (name.startswith(f"{stem}-") and name.endswith(ext)):
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) > MATRIX_STALE_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+def update_distance_matrix(store_dir, output_file, index_file, tile_size=256, workers=None, full=False):
+    manifest, _, _ = read_store(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No feature store found in {store_dir}")
+    image_files = [entry["path"] for entry in manifest["entries"]]
+    hashes = [entry["hash"] for entry in manifest["entries"]]
+    store_rows = {(img_file, content_hash): row for row, (img_file, content_hash) in enumerate(zip(image_files, hashes))}
+
+    # keep the rows of images that are unchanged since the last run, in their existing order
+    index = old_matrix = None
+    if not full:
+        try:
+            index, old_matrix = read_distance_matrix(output_file, index_file)
+        except (OSError, ValueError) as e:
+            # a missing or mismatched matrix cannot be trusted, so every distance is recomputed
+            print(f"Distance matrix: {e}, recomputing every image")
+    kept_old_rows = []
+    rows = []
+    if old_matrix is not None:
+        for old_row, key in enumerate(zip(index["images"], index["hashes"])):
+            if key in store_rows:
+                kept_old_rows.append(old_row)
+                rows.append(store_rows[key])
+
+    # new and changed images go at the end
+    kept = set(rows)
+    new_start = len(rows)
+    rows.extend(row for row in range(len(image_files)) if row not in kept)
+    n = len(rows)
+
+    if old_matrix is not None and new_start == n and n == len(old_matrix) and kept_old_rows == list(range(n)):
+        print(f"Distance matrix of {n} images is up to date")
+        return load_distance_matrix(output_file, index_file)
+
+    print(f"Distance matrix: keeping {new_start} images, dropping {len(old_matrix) - new_start if old_matrix is not None else 0} images, computing {n - new_start} images")
+
+    matrix_path = new_matrix_path(output_file)
+    distance_matrix = np.lib.format.open_memmap(matrix_path, mode="w+", dtype=np.float64, shape=(n, n))
+
+    # copy the kept block over in row chunks so memory stays bounded
+    kept_old_rows = np.array(kept_old_rows, dtype=np.int64)
+    for start in range(0, new_start, tile_size):
+        end = min(start + tile_size, new_start)
+        distance_matrix[start:end, :new_start] = old_matrix[kept_old_rows[start:end]][:, kept_old_rows]
+    distance_matrix.flush()
+    del distance_matrix, old_matrix
+
+    rows = np.array(rows, dtype=np.int64)
+    tiles = pending_tiles(n, new_start, tile_size)
+    if tiles:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(store_dir, matrix_path, rows, tile_size)) as executor:
+            for done, _ in enumerate(executor.map(compute_tile, tiles), 1):
+                print(f"\rComputed {done}/{len(tiles)} tiles", end="", flush=True)
+        print()
+
+    commit_distance_matrix(output_file, index_file, matrix_path, [image_files[row] for row in rows], [hashes[row] for row in rows])
+    return load_distance_matrix(output_file, index_file)
+
+if __name__ == "__main__":
+    load_feature_store(segmented_images, store_dir)
+
+    start_time = time.perf_counter()
+    image_files, distance_matrix = update_distance_matrix(store_dir, output_file, index_file, tile_size=tile_size,
+                                                          workers=workers, full="--full" in sys.argv)
+    end_time = time.perf_counter()
+
+    print(distance_matrix.max(), distance_matrix.min())
+    print(f"Distance matrix of {len(image_files)} images ready in {end_time - start_time:.4f}s")
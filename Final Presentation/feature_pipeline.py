@@ -0,0 +1,64 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+
+from histogram_intersection import compute_3d_hist, compute_lbp_hist
+
+'''
+Parallel feature extraction pipeline
+    - splits the image files into chunks and extracts color and LBP histograms in a process pool
+        - compute_lbp_hist (24 points, radius 3) dominates, so the work scales with core count
+        - chunking keeps inter-process overhead low for the small segmented images
+    - ordered=True yields results in input order, ordered=False yields chunks as soon as they finish
+    - progress prints a running count of extracted images
+    - falls back to extracting in-process for a single worker or a handful of images
+    - scripts using it must keep their top-level code under `if __name__ == "__main__":`
+      (worker processes re-import the main module on Windows)
+'''
+
+def compute_features(img_file):
+    image = cv2.imread(img_file)
+    return compute_3d_hist(image), compute_lbp_hist(image)
+
+def extract_chunk(img_files):
+    return [(img_file, compute_features(img_file)) for img_file in img_files]
+
+def default_workers():
+    return os.cpu_count() or 1
+
+# yields (img_file, (color_hist, lbp_hist)) for every image file
+def iter_features(image_files, workers=None, chunksize=8, ordered=True, progress=False):
+    image_files = list(image_files)
+    workers = workers or default_workers()
+    total = len(image_files)
+    done = 0
+
+    chunks = [image_files[i:i + chunksize] for i in range(0, total, chunksize)]
+    if workers <= 1 or len(chunks) <= 1:
+        results = map(extract_chunk, chunks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(chunks)))
+        if ordered:
+            results = executor.map(extract_chunk, chunks)
+        else:
+            results = (future.result() for future in as_completed([executor.submit(extract_chunk, chunk) for chunk in chunks]))
+
+    try:
+        for chunk_results in results:
+            for item in chunk_results:
+                yield item
+            done += len(chunk_results)
+            if progress:
+                print(f"\rExtracted features for {done}/{total} images", end="", file=sys.stderr, flush=True)
+        if progress and total > 0:
+            print(file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+# extracts features for every image file, returned in input order
+def extract_features(image_files, workers=None, chunksize=8, progress=False):
+    return list(iter_features(image_files, workers=workers, chunksize=chunksize, ordered=True, progress=progress))
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+
+from feature_pipeline import iter_features
+
+'''
+Persistent on-disk feature store for the segmented parasite images
+    - color histograms (N x 512, float32) and LBP histograms (N x 26, float64) are saved as .npy blocks
+    - manifest.json records the path, size, mtime and content hash of the image behind every row
+    - on load, unchanged images are served straight from the memory-mapped blocks (zero-copy)
+    - new or changed images are the only ones whose histograms are recomputed
+        - they go through the parallel extraction pipeline in feature_pipeline.py
+        - a file whose mtime changed but whose content hash did not is reused as-is
+    - deleted images are dropped from the store
+    - the manifest fingerprint identifies the exact feature set (used to detect stale indexes)
+    - the manifest is the single commit point of an update
+        - every update writes its blocks to new, uniquely named files (color-<token>.npy, lbp-<token>.npy)
+          and the manifest records which blocks its rows live in
+        - the manifest itself is swapped in atomically, so a reader sees either the old rows and blocks or the new ones,
+          even if the update dies halfway or several processes update the same store at once
+        - blocks no manifest points to any more are deleted after the swap, or swept once they are old enough
+        - opening the store checks the blocks' row counts against the manifest
+        - stores written before blocks were named in the manifest (color.npy, lbp.npy) are still read
+'''
+
+STORE_VERSION = 1
+COLOR_FILE = "color.npy"
+LBP_FILE = "lbp.npy"
+MANIFEST_FILE = "manifest.json"
+COLOR_BLOCK_PREFIX = "color-"
+LBP_BLOCK_PREFIX = "lbp-"
+# blocks no manifest points to, older than this, are left over from an interrupted or displaced update
+STORE_STALE_SECONDS = 600
+
+# content hash of an image file
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# fingerprint of the whole feature set - changes whenever any row changes
+def compute_fingerprint(entries):
+    digest = hashlib.sha1(f"v{STORE_VERSION}".encode())
+    for entry in entries:
+        digest.update(f"{entry['path']}:{entry['hash']}\n".encode())
+    return digest.hexdigest()
+
+def list_image_files(image_dir):
+    return sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir))
+
+def read_manifest(store_dir):
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != STORE_VERSION:
+        return None
+    return manifest
+
+# atomically replaces the manifest, recording the block files its rows live in
+def write_manifest(store_dir, entries, color_file=COLOR_FILE, lbp_file=LBP_FILE):
+    manifest = {"version": STORE_VERSION, "fingerprint": compute_fingerprint(entries), "color_file": color_file, "lbp_file": lbp_file, "entries": entries}
+    fd, tmp_manifest = tempfile.mkstemp(prefix="manifest.", suffix=".tmp", dir=store_dir)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_manifest, os.path.join(store_dir, MANIFEST_FILE))
+
+def get_store_fingerprint(store_dir):
+    manifest = read_manifest(store_dir)
+    return manifest["fingerprint"] if manifest else None
+
+# (color block, lbp block) file names of a manifest
+def get_block_files(manifest):
+    return manifest.get("color_file", COLOR_FILE), manifest.get("lbp_file", LBP_FILE)
+
+# paths for the blocks of a new update, unique so concurrent updates never write the same files
+def new_block_paths(store_dir):
+    fd, color_path = tempfile.mkstemp(prefix=COLOR_BLOCK_PREFIX, suffix=".npy", dir=store_dir)
+    os.close(fd)
+    token = os.path.basename(color_path)[len(COLOR_BLOCK_PREFIX):]
+    return color_path, os.path.join(store_dir, LBP_BLOCK_PREFIX + token)
+
+# memory-maps a manifest's blocks, checking their row counts against its entries
+def open_blocks(store_dir, manifest):
+    color_file, lbp_file = get_block_files(manifest)
+    color_matrix = np.load(os.path.join(store_dir, color_file), mmap_mode="r")
+    lbp_matrix = np.load(os.path.join(store_dir, lbp_file), mmap_mode="r")
+    if len(color_matrix) != len(manifest["entries"]) or len(lbp_matrix) != len(manifest["entries"]):
+        raise ValueError(f"Feature store in {store_dir} is inconsistent: the manifest lists {len(manifest['entries'])} images, "
+                         f"{color_file} holds {len(color_matrix)} rows and {lbp_file} holds {len(lbp_matrix)}")
+    return color_matrix, lbp_matrix
+
+# swaps in the manifest of an update, then deletes the blocks it replaced
+def commit_blocks(store_dir, entries, color_file, lbp_file):
+    previous = read_manifest(store_dir)
+    write_manifest(store_dir, entries, color_file, lbp_file)
+    if previous is not None:
+        for name in get_block_files(previous):
+            if name not in (color_file, lbp_file):
+                try:
+                    os.remove(os.path.join(store_dir, name))
+                except OSError:
+                    pass
+    # blocks of updates that died or were displaced by a concurrent one, old enough that no update is still writing them
+    current = read_manifest(store_dir)
+    referenced = {color_file, lbp_file} | (set(get_block_files(current)) if current is not None else set())
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        stale_block = name.startswith((COLOR_BLOCK_PREFIX, LBP_BLOCK_PREFIX)) and name.endswith(".npy")
+        if name in referenced or not (stale_block or (name.startswith("manifest.") and name.endswith(".tmp"))):
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) > STORE_STALE_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+# the current manifest and its memory-mapped blocks, or (None, None, None) if there is no store
+def read_store(store_dir):
+    manifest = read_manifest(store_dir)
+    while manifest is not None:
+        try:
+            return (manifest,) + open_blocks(store_dir, manifest)
+        except OSError:
+            # a newer update replaced these blocks while they were being opened, open that one instead
+            latest = read_manifest(store_dir)
+            if latest is None or get_block_files(latest) == get_block_files(manifest):
+                raise
+            manifest = latest
+    return None, None, None
+
+# opens the stored blocks read-only without copying them into memory
+def open_feature_store(store_dir):
+    manifest, color_matrix, lbp_matrix = read_store(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No feature store found in {store_dir}")
+    image_files = [entry["path"] for entry in manifest["entries"]]
+    return image_files, np.asarray(color_matrix), np.asarray(lbp_matrix)
+
+# loads features for every image in image_dir, recomputing only new or changed images
+#   - workers sets the number of extraction processes (defaults to the core count)
+def load_feature_store(image_dir, store_dir="features", workers=None, progress=True):
+    os.makedirs(store_dir, exist_ok=True)
+    image_files = list_image_files(image_dir)
+
+    old_rows = {}
+    try:
+        manifest, old_color, old_lbp = read_store(store_dir)
+    except (OSError, ValueError) as e:
+        # missing or mismatched blocks: nothing in them can be trusted, so every image is recomputed
+        print(f"Feature store: {e}, recomputing every image")
+        manifest = old_color = old_lbp = None
+    if manifest is not None:
+        old_rows = {entry["path"]: (row, entry) for row, entry in enumerate(manifest["entries"])}
+
+    # match every image against the manifest (size/mtime first, content hash only when those changed)
+    entries = []
+    sources = []
+    for img_file in image_files:
+        stat = os.stat(img_file)
+        entry = {"path": img_file, "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": None}
+        old = old_rows.get(img_file)
+        if old is not None and old[1]["size"] == stat.st_size and old[1]["mtime"] == stat.st_mtime_ns:
+            entry["hash"] = old[1]["hash"]
+            sources.append(old[0])
+        else:
+            entry["hash"] = hash_file(img_file)
+            sources.append(old[0] if old is not None and old[1]["hash"] == entry["hash"] else None)
+        entries.append(entry)
+
+    # every row is still valid - at most the recorded mtimes need refreshing
+    if manifest is not None and len(entries) == len(manifest["entries"]) and sources == list(range(len(entries))):
+        del old_color, old_lbp
+        if entries != manifest["entries"]:
+            write_manifest(store_dir, entries, *get_block_files(manifest))
+        return open_feature_store(store_dir)
+
+    # write the updated blocks next to the old ones, then swap them in with the manifest
+    recomputed = sum(source is None for source in sources)
+    print(f"Feature store: reusing {len(entries) - recomputed} images, computing {recomputed} images")
+
+    to_compute = [img_file for img_file, source in zip(image_files, sources) if source is None]
+    computed = dict(iter_features(to_compute, workers=workers, ordered=False, progress=progress))
+
+    n_color = old_color.shape[1] if old_color is not None else None
+    n_lbp = old_lbp.shape[1] if old_lbp is not None else None
+    color_rows = [None] * len(entries)
+    lbp_rows = [None] * len(entries)
+    for row, (img_file, source) in enumerate(zip(image_files, sources)):
+        if source is None:
+            color_rows[row], lbp_rows[row] = computed[img_file]
+        else:
+            color_rows[row], lbp_rows[row] = old_color[source], old_lbp[source]
+        n_color, n_lbp = len(color_rows[row]), len(lbp_rows[row])
+    del computed
+
+    color_path, lbp_path = new_block_paths(store_dir)
+    color_out = np.lib.format.open_memmap(color_path, mode="w+", dtype=np.float32, shape=(len(entries), n_color or 0))
+    lbp_out = np.lib.format.open_memmap(lbp_path, mode="w+", dtype=np.float64, shape=(len(entries), n_lbp or 0))
+    for row in range(len(entries)):
+        color_out[row] = color_rows[row]
+        lbp_out[row] = lbp_rows[row]
+    color_out.flush()
+    lbp_out.flush()
+
+    # release every mapping of the old blocks before deleting them (required on Windows)
+    del color_out, lbp_out, color_rows, lbp_rows, old_color, old_lbp
+    commit_blocks(store_dir, entries, os.path.basename(color_path), os.path.basename(lbp_path))
+    return open_feature_store(store_dir)
+
+# (image_name, (color_hist, lbp_hist)) pairs - row views into the store, no copies
+def get_image_features(image_files, color_matrix, lbp_matrix):
+    return [(img_file, (color_matrix[i], lbp_matrix[i])) for i, img_file in enumerate(image_files)]
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from histogram_intersection import compute_3d_hist, compute_lbp_hist
+from feature_store import load_feature_store, new_block_paths, commit_blocks
+from feature_pipeline import default_workers
+
+'''
+Script to generate a large synthetic collection for scale testing, written in the feature store format
+    - starts from the real features of "images/segmented" and the labels of one ground truth cluster file
+    - optional image augmentation (--augment): every segmented parasite is flipped, rotated and colour-jittered,
+      and the histograms of each variant are computed like a real image's (in a process pool)
+    - the rest of the collection is made by perturbing and mixing real (and augmented) feature vectors
+        - each item starts from a random source image and is mixed with a random image of the same cluster
+        - color histograms get multiplicative log-normal noise on their nonzero bins only,
+          so the white-background sparsity of the real histograms is kept
+        - LBP histograms get the same kind of noise on every bin
+        - both are renormalized to sum to 1, like compute_3d_hist/compute_lbp_hist
+    - every generated item keeps the cluster of its source image, so precision and recall stay meaningful
+    - writes {output}/features (color/lbp blocks and the manifest.json naming them) and {output}/clusters/{cluster file}
+        - entries record the source image, and their hash is the hash of the item's histograms
+        - the real images are included by default, so the server can still be queried with uploads from images/segmented
+    - blocks are written in chunks through memory-mapped .npy files, so 1M items do not need to fit in memory
+    - usage: python generate_synthetic.py --size 100000 [--augment] [--output synthetic]
+        - benchmark: python benchmark.py --store synthetic/features --no-update
+        - server: set FEATURE_STORE_DIR = "synthetic/features" and UPDATE_FEATURE_STORE = False in interface/backend/app.py
+'''
+
+AUGMENTATIONS = ("flip_h", "flip_v", "rot90", "rot180", "rot270", "transpose", "jitter", "flip_h_jitter")
+
+# applies one named augmentation to a BGR image on a white background
+def augment_image(image, augmentation, rng):
+    if augmentation.startswith("flip_h"):
+        image = cv2.flip(image, 1)
+    elif augmentation == "flip_v":
+        image = cv2.flip(image, 0)
+    elif augmentation == "rot90":
+        image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    elif augmentation == "rot180":
+        image = cv2.rotate(image, cv2.ROTATE_180)
+    elif augmentation == "rot270":
+        image = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    elif augmentation == "transpose":
+        image = cv2.transpose(image)
+
+    if augmentation.endswith("jitter"):
+        # scale every channel of the parasite (not the white background) by up to +-10%
+        foreground = np.any(image < 255, axis=2)
+        scale = rng.uniform(0.9, 1.1, size=3)
+        jittered = image.astype(np.float32)
+        jittered[foreground] = np.clip(jittered[foreground] * scale, 0, 254)
+        image = jittered.astype(np.uint8)
+    return image
+
+def augment_chunk(tasks):
+    results = []
+    for img_file, augmentations, seed in tasks:
+        image = cv2.imread(img_file)
+        rng = np.random.RandomState(seed)
+        for augmentation in augmentations:
+            augmented = augment_image(image, augmentation, rng)
+            results.append((f"{img_file}#{augmentation}", img_file, compute_3d_hist(augmented), compute_lbp_hist(augmented)))
+    return results
+
+# (name, source image, color_hist, lbp_hist) for every augmented variant of the given images
+def get_augmented_features(image_files, augmentations=AUGMENTATIONS, seed=0, workers=None, chunksize=8):
+    tasks = [(img_file, augmentations, seed + i) for i, img_file in enumerate(image_files)]
+    chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+    workers = workers or default_workers()
+    if workers <= 1 or len(chunks) <= 1:
+        chunk_results = map(augment_chunk, chunks)
+        return [item for chunk in chunk_results for item in chunk]
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        return [item for chunk in executor.map(augment_chunk, chunks) for item in chunk]
+
+# multiplicative log-normal noise on the nonzero bins, renormalized to sum to 1
+def perturb_histograms(hists, sigma, rng):
+    noisy = hists * np.exp(sigma * rng.standard_normal(hists.shape))
+    return noisy / noisy.sum(axis=1, keepdims=True)
+
+# perturbed mixtures of the base rows, keeping the cluster of each item's source
+#   - mix is the largest weight given to the second image of the same cluster
+def generate_features(color_base, lbp_base, base_labels, count, rng, mix=0.3, color_sigma=0.15, lbp_sigma=0.05):
+    # rows grouped by label, so a random partner of the same cluster is one index lookup
+    by_label = np.argsort(base_labels, kind="stable")
+    label_sizes = np.bincount(base_labels)
+    label_starts = np.concatenate([[0], np.cumsum(label_sizes)[:-1]])
+
+    sources = rng.randint(len(base_labels), size=count)
+    source_labels = base_labels[sources]
+    partners = by_label[label_starts[source_labels] + (rng.uniform(size=count) * label_sizes[source_labels]).astype(np.int64)]
+    weights = rng.uniform(0, mix, size=(count, 1))
+
+    color = (1 - weights) * color_base[sources] + weights * color_base[partners]
+    lbp = (1 - weights) * lbp_base[sources] + weights * lbp_base[partners]
+    color = perturb_histograms(color, color_sigma, rng).astype(np.float32)
+    lbp = perturb_histograms(lbp, lbp_sigma, rng).astype(np.float64)
+    return sources, color, lbp
+
+def hash_features(color_hist, lbp_hist):
+    digest = hashlib.sha1(np.ascontiguousarray(color_hist).tobytes())
+    digest.update(np.ascontiguousarray(lbp_hist).tobytes())
+    return digest.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic feature store for scale testing")
+    parser.add_argument("--images", default="images/segmented")
+    parser.add_argument("--store", default="features", help="feature store of the real images")
+    parser.add_argument("--clusters", default="clusters/k_means_clusters.json", help="ground truth cluster file whose labels are kept")
+    parser.add_argument("--size", type=int, default=100000, help="number of images in the synthetic collection")
+    parser.add_argument("--output", default="synthetic")
+    parser.add_argument("--augment", action="store_true", help="also flip/rotate/colour-jitter the segmented images")
+    parser.add_argument("--no-real", action="store_true", help="leave the real images out of the collection")
+    parser.add_argument("--mix", type=float, default=0.3)
+    parser.add_argument("--color-sigma", type=float, default=0.15)
+    parser.add_argument("--lbp-sigma", type=float, default=0.05)
+    parser.add_argument("--chunk", type=int, default=65536, help="items generated and written at a time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    rng = np.random.RandomState(args.seed)
+
+    # real features and their cluster labels (unclustered images are not used as sources)
+    image_files, color_matrix, lbp_matrix = load_feature_store(args.images, args.store)
+    img_to_idx = {img_file: idx for idx, img_file in enumerate(image_files)}
+    with open(args.clusters, "r") as f:
+        clusters = json.load(f)["clusters"]
+    cluster_names = list(clusters)
+    labels = np.full(len(image_files), -1, dtype=np.int64)
+    for cluster_id, cluster in enumerate(cluster_names):
+        for img in clusters[cluster]:
+            if img in img_to_idx:
+                labels[img_to_idx[img]] = cluster_id
+    clustered = np.flatnonzero(labels >= 0)
+    if len(clustered) == 0:
+        raise ValueError(f"No image in {args.store} is listed in {args.clusters}")
+
+    base_names = [image_files[row] for row in clustered]
+    base_sources = list(base_names)
+    color_base = [np.asarray(color_matrix[clustered], dtype=np.float64)]
+    lbp_base = [np.asarray(lbp_matrix[clustered], dtype=np.float64)]
+    base_labels = [labels[clustered]]
+
+    if args.augment:
+        augmented = get_augmented_features(base_names, seed=args.seed)
+        base_names += [name for name, _, _, _ in augmented]
+        base_sources += [source for _, source, _, _ in augmented]
+        color_base.append(np.array([color for _, _, color, _ in augmented], dtype=np.float64))
+        lbp_base.append(np.array([lbp for _, _, _, lbp in augmented], dtype=np.float64))
+        base_labels.append(np.array([labels[img_to_idx[source]] for _, source, _, _ in augmented], dtype=np.int64))
+        print(f"Augmented {len(clustered)} images into {len(augmented)} variants")
+    color_base = np.concatenate(color_base)
+    lbp_base = np.concatenate(lbp_base)
+    base_labels = np.concatenate(base_labels)
+
+    # real (and augmented) images come first, generated items fill the rest
+    kept = 0 if args.no_real else min(len(base_names), args.size)
+    n = args.size
+
+    store_dir = os.path.join(args.output, "features")
+    cluster_dir = os.path.join(args.output, "clusters")
+    os.makedirs(store_dir, exist_ok=True)
+    os.makedirs(cluster_dir, exist_ok=True)
+    color_path, lbp_path = new_block_paths(store_dir)
+    color_out = np.lib.format.open_memmap(color_path, mode="w+", dtype=np.float32, shape=(n, color_base.shape[1]))
+    lbp_out = np.lib.format.open_memmap(lbp_path, mode="w+", dtype=np.float64, shape=(n, lbp_base.shape[1]))
+
+    entries = []
+    members = {cluster: [] for cluster in cluster_names}
+    color_out[:kept] = color_base[:kept]
+    lbp_out[:kept] = lbp_base[:kept]
+    for row in range(kept):
+        entries.append({"path": base_names[row], "size": 0, "mtime": 0, "hash": hash_features(color_out[row], lbp_out[row]), "source": base_sources[row]})
+        members[cluster_names[base_labels[row]]].append(base_names[row])
+
+    for start in range(kept, n, args.chunk):
+        end = min(start + args.chunk, n)
+        sources, color, lbp = generate_features(color_base, lbp_base, base_labels, end - start, rng,
+                                                mix=args.mix, color_sigma=args.color_sigma, lbp_sigma=args.lbp_sigma)
+        color_out[start:end] = color
+        lbp_out[start:end] = lbp
+        for offset, source in enumerate(sources):
+            name = f"synthetic/item_{start + offset:07d}"
+            entries.append({"path": name, "size": 0, "mtime": 0, "hash": hash_features(color[offset], lbp[offset]), "source": base_sources[source]})
+            members[cluster_names[base_labels[source]]].append(name)
+        print(f"\rGenerated {end}/{n} images", end="", flush=True)
+    print()
+
+    color_out.flush()
+    lbp_out.flush()
+    del color_out, lbp_out
+    commit_blocks(store_dir, entries, os.path.basename(color_path), os.path.basename(lbp_path))
+
+    cluster_file = os.path.join(cluster_dir, os.path.basename(args.clusters))
+    with open(cluster_file, "w") as f:
+        json.dump({"clusters": members}, f, indent=4)
+
+    end_time = time.perf_counter()
+    print(f"Wrote {n} images ({kept} real/augmented) to {store_dir} and their clusters to {cluster_file} in {end_time - start_time:.4f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,20 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
-import shutil
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import os
-import cv2
+import asyncio
 import numpy as np
-from lib.histogram_intersection import compute_3d_hist, compute_lbp_hist, get_histogram_distance
-from lib.vp_tree import build_vptree, search_vptree
-import json
+from lib.vp_tree import build_vptree_from_matrix, save_vptree, load_vptree
+from lib.feature_store import load_feature_store, open_feature_store, get_store_fingerprint
+from lib.cluster_registry import ClusterRegistry
+from lib.feature_cache import FeatureCache, hash_bytes
+from lib.result_cache import ResultCache
+from lib.quantized_features import open_quantized_store
+from lib.query_worker import worker_state, set_worker_state, init_worker, run_query, extract_batch_features, run_batch
+from lib.query_limiter import QueryLimiter, QueueFull, ClientDisconnected
 
 
 app = FastAPI()
@@ -22,105 +28,247 @@ app.add_middleware(
 )
 
 # load image features for VP tree
+#   - the store in FEATURE_STORE_DIR is brought up to date with images/segmented at startup
+#   - set UPDATE_FEATURE_STORE = False to serve a store as-is, e.g. a synthetic collection from generate_synthetic.py
+#     (FEATURE_STORE_DIR = "synthetic/features", CLUSTER_DIR = "synthetic/clusters")
 segmented_images = "images/segmented"
-segmented_image_files = [os.path.join(segmented_images, f) for f in os.listdir(segmented_images)]
+FEATURE_STORE_DIR = "features"
+UPDATE_FEATURE_STORE = True
+CLUSTER_DIR = "clusters"
+if UPDATE_FEATURE_STORE:
+    segmented_image_files, color_matrix, lbp_matrix = load_feature_store(segmented_images, FEATURE_STORE_DIR)
+else:
+    segmented_image_files, color_matrix, lbp_matrix = open_feature_store(FEATURE_STORE_DIR)
 all_image_names = set(segmented_image_files)
 app.mount("/images/segmented", StaticFiles(directory=segmented_images), name="images")
 
-image_features = []
-for img_file in segmented_image_files:
-    image = cv2.imread(img_file)
-    color_hist = compute_3d_hist(image)
-    lbp_hist = compute_lbp_hist(image)
-    image_features.append((img_file, (color_hist, lbp_hist)))
-
 img_to_idx = {img_file: idx for idx, img_file in enumerate(segmented_image_files)}
 
-# build VP tree
-vptree = build_vptree(image_features)
+# load the saved VP tree, rebuilding it only if it is missing, stale or built with another leaf size or seed
+#   - leaves hold up to VPTREE_LEAF_SIZE images scanned in one vectorized pass
+#   - a fixed seed keeps the tree (and comparison counts) identical across restarts and workers
+VPTREE_INDEX = "indexes/vptree"
+VPTREE_LEAF_SIZE = 8
+VPTREE_SEED = 0
+feature_fingerprint = get_store_fingerprint(FEATURE_STORE_DIR)
+# lower-bound filter cascade (lib/bound_cascade.py) for exhaustive search and the VP tree's leaves
+#   - candidates are dropped by cheap LBP / coarse color bounds before the full intersection, results stay exact
+#   - it pays off on large collections where most images are far from the query, not on the 412 segmented parasites
+BOUND_CASCADE = False
+vptree = load_vptree(VPTREE_INDEX, fingerprint=feature_fingerprint, bound_cascade=BOUND_CASCADE)
+if vptree is None or vptree.leaf_size != VPTREE_LEAF_SIZE or vptree.seed != VPTREE_SEED:
+    vptree = build_vptree_from_matrix(segmented_image_files, color_matrix, lbp_matrix, leaf_size=VPTREE_LEAF_SIZE, seed=VPTREE_SEED, bound_cascade=BOUND_CASCADE)
+    if vptree is not None:
+        save_vptree(vptree, VPTREE_INDEX, fingerprint=feature_fingerprint)
+
+# ground truth clusters, loaded once and reloaded when a file in clusters/ changes
+cluster_registry = ClusterRegistry(CLUSTER_DIR, img_to_idx)
+
+# features of recently uploaded images, keyed by the hash of the upload's bytes
+FEATURE_CACHE_SIZE = 1024
+feature_cache = FeatureCache(max_entries=FEATURE_CACHE_SIZE)
+
+# compact uint16 copy of the features (lib/quantized_features.py) - exhaustive search scans it with integer
+# intersection and rescores only its candidates against the float features, so results stay exact
+QUANTIZED_FEATURES = False
+quantized_matrices = open_quantized_store(FEATURE_STORE_DIR)[1:] if QUANTIZED_FEATURES else None
+
+# sparse (CSR) color rows for exhaustive and batch search (lib/sparse_histograms.py) - None picks them when few bins are nonzero,
+# True / False forces either form; the sparse kernel only filters candidates that are rescored on dense rows, so results stay exact
+SPARSE_HISTOGRAMS = None
+set_worker_state(segmented_image_files, color_matrix, lbp_matrix, vptree, feature_cache, quantized=quantized_matrices, bound_cascade=BOUND_CASCADE,
+                 sparse=SPARSE_HISTOGRAMS)
+
+# finished /query responses, keyed by (upload hash, file name, method, tau, k, cluster file)
+#   - RESULT_CACHE_BYTES bounds the estimated memory of the cached responses, RESULT_CACHE_TTL their age in seconds
+#   - the cache is emptied whenever index_version() changes
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL = 3600.0
+result_cache = ResultCache(max_bytes=RESULT_CACHE_BYTES, ttl=RESULT_CACHE_TTL)
+
+# identifies the data a response was computed from: the feature store, the VP tree built on it and the cluster files
+def index_version():
+    return (feature_fingerprint, VPTREE_LEAF_SIZE, VPTREE_SEED, QUANTIZED_FEATURES, BOUND_CASCADE, SPARSE_HISTOGRAMS, cluster_registry.version)
+
+# decoding, feature extraction and search run in an executor, never on the event loop
+#   - "thread" shares the state above (NumPy, OpenCV and skimage release the GIL for the heavy parts)
+#   - "process" starts workers that map the feature store and saved VP tree themselves, each with its own feature cache
+#   - at most MAX_CONCURRENT_QUERIES run at once and MAX_WAITING_QUERIES wait for a slot (up to QUERY_QUEUE_TIMEOUT seconds),
+#     any further query gets a 503
+QUERY_EXECUTOR = "thread"
+QUERY_WORKERS = os.cpu_count() or 1
+MAX_CONCURRENT_QUERIES = QUERY_WORKERS
+MAX_WAITING_QUERIES = 4 * QUERY_WORKERS
+QUERY_QUEUE_TIMEOUT = 10.0
+# a batch's uploads are extracted in chunks of at least this many images, at most MAX_CONCURRENT_QUERIES chunks at once
+BATCH_EXTRACTION_CHUNK = 8
+if QUERY_EXECUTOR == "process":
+    query_executor = ProcessPoolExecutor(max_workers=QUERY_WORKERS, initializer=init_worker,
+                                         initargs=(FEATURE_STORE_DIR, VPTREE_INDEX, feature_fingerprint, FEATURE_CACHE_SIZE, QUANTIZED_FEATURES, BOUND_CASCADE, SPARSE_HISTOGRAMS))
+else:
+    query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+query_limiter = QueryLimiter(query_executor, MAX_CONCURRENT_QUERIES, MAX_WAITING_QUERIES, queue_timeout=QUERY_QUEUE_TIMEOUT)
+
+# runs func(*args) through the query limiter, returns (result, None) or (None, error response)
+async def run_limited(request, func, *args):
+    try:
+        return await query_limiter.run(request, func, *args), None
+    except QueueFull:
+        return None, JSONResponse(status_code=503, headers={"Retry-After": "1"}, content={"error": "Server busy, try again shortly"})
+    except ClientDisconnected:
+        return None, JSONResponse(status_code=499, content={"error": "Client disconnected"})
+
+# looks up a ground truth cluster file, returns (cluster_set, None) or (None, error response)
+def get_cluster_set(cluster):
+    cluster_set = cluster_registry.get(cluster)
+    if cluster_set is None:
+        return None, JSONResponse(status_code=400, content={"error": "Invalid cluster", "clusters": cluster_registry.names()})
+    return cluster_set, None
+
+# formats fetched (image_name, distance) pairs and scores them against the query's ground truth cluster
+def summarize_results(fetched_relevant_images, cluster_set, query_img_path):
+    query_cluster = cluster_set.labels[img_to_idx[query_img_path]]
+    relevant_images = int(cluster_set.sizes[query_cluster]) if query_cluster >= 0 else 0
+
+    results = []
+    relevant_retrieved = 0
+    for img_name, dist in fetched_relevant_images:
+        img_cluster = cluster_set.labels[img_to_idx[img_name]]
+        results.append({
+            "image_name": img_name,
+            "cluster": cluster_set.cluster_names[img_cluster] if img_cluster >= 0 else None,
+            "distance": dist,
+        })
+        if query_cluster >= 0 and img_cluster == query_cluster:
+            relevant_retrieved += 1
+    retrieved = len(fetched_relevant_images)
+
+    results = sorted(results, key=lambda x: x["distance"])
+    precision = relevant_retrieved / retrieved if retrieved > 0 else 0
+    recall = relevant_retrieved / relevant_images if relevant_images > 0 else 0
+    return results, precision, recall
 
 # API endpoints
 @app.post("/query")
-async def query_image(method: str = Form(...), cluster: str = Form(...), file: UploadFile = File(...)):
+async def query_image(request: Request, method: str = Form(...), cluster: str = Form(...), file: UploadFile = File(...), k: Optional[int] = Form(None)):
     original_img_path = os.path.join("images/segmented", file.filename)
     if original_img_path not in all_image_names:
         return JSONResponse(status_code=400, content={"error": "Invalid image input, please use one from the database"})
-    
-    temp_path = f"temp_{file.filename}"
-    with open (temp_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    if k is not None and k <= 0:
+        return JSONResponse(status_code=400, content={"error": "k must be a positive integer"})
+    cluster_set, error = get_cluster_set(cluster)
+    if error is not None:
+        return error
 
-    query_image = cv2.imread(temp_path)
-    color_hist = compute_3d_hist(query_image)
-    lbp_hist = compute_lbp_hist(query_image)
-    query_feature = (color_hist, lbp_hist)
+    # radius search with tau, or the k nearest images when k is given
+    tau = 0.14 if k is None else None
 
-    os.remove(temp_path)
-
-    tau = 0.14
-    results = []
+    method = method.lower().strip()
+    data = await file.read()
+    cache_key = (hash_bytes(data), original_img_path, method, tau, k, cluster)
+    version = index_version()
+    cached = result_cache.get(cache_key, version)
+    if cached is not None:
+        return cached
 
-    relevant_retrieved = 0
-    retrieved = 0
-    total_comparisons = 0
-
-    # get clusters
-    with open(f"clusters/{cluster}.json", "r") as f:
-        clusters = json.load(f)["clusters"]
-
-    # mapping of images to corresponding clusters
-    img_to_cluster = {}
-    for clust in clusters:
-        for img in clusters[clust]:
-            img_to_cluster[img] = clust
-    
-    query_cluster = img_to_cluster[original_img_path]
-    relevant_images = len(clusters[query_cluster])
+    query_result, error = await run_limited(request, run_query, data, method, tau, k)
+    if error is not None:
+        return error
+    query_error, search_result = query_result
+    if query_error is not None:
+        return JSONResponse(status_code=400, content={"error": query_error})
+    fetched_relevant_images, total_comparisons = search_result
 
-    method = method.lower().strip()
-    if method == "exhaustive":
-        for img_name, img_feature in image_features:
-            dist = get_histogram_distance(query_feature[0], img_feature[0], query_feature[1], img_feature[1], a=0.2, b=0.8)
-            if dist <= tau:
-                results.append({
-                    "image_name": img_name,
-                    "cluster": img_to_cluster[img_name],
-                    "distance": dist,
-                })
-            total_comparisons += 1
-
-        retrieved = len(results)
-        for res in results:
-            if img_to_cluster[res["image_name"]] == query_cluster:
-                relevant_retrieved += 1
-
-    elif method == "vp_tree":
-        fetched_relevant_images, comparisons = search_vptree(vptree, query_feature, tau)
-        for img_name, dist in fetched_relevant_images:
-            results.append({
-                "image_name": img_name,
-                "cluster": img_to_cluster[img_name],
-                "distance": dist
-            })
-        total_comparisons = comparisons
-
-        retrieved = len(fetched_relevant_images)
-        for img_name, _ in fetched_relevant_images:
-            if img_to_cluster[img_name] == query_cluster:
-                relevant_retrieved += 1
-    
-    else:
-        return JSONResponse(status_code=400, content={"error": "Invalid method"})
-    
-    results = sorted(results, key=lambda x: x["distance"])
-    return {
+    results, precision, recall = summarize_results(fetched_relevant_images, cluster_set, original_img_path)
+    response = {
         "status": 200,
         "results": results,
         "method": method,
-        "precision": relevant_retrieved / retrieved if retrieved > 0 else 0,
-        "recall": relevant_retrieved / relevant_images if relevant_images > 0 else 0,
+        "k": k,
+        "precision": precision,
+        "recall": recall,
         "comparisons": total_comparisons
     }
+    result_cache.put(cache_key, version, response)
+    return response
+
+# batch queries - uploaded files and/or comma-separated image IDs (file names in images/segmented)
+#   - uploads are split into chunks extracted in parallel, each chunk one job in the query executor taking one query slot
+#     (at most MAX_CONCURRENT_QUERIES chunks, so one batch never fills the waiting queue by itself)
+#   - database images given by ID reuse their stored features
+#   - all queries are scored together as one blocked Q x N distance matrix
+@app.post("/query/batch")
+async def query_batch(request: Request, cluster: str = Form(...), files: Optional[List[UploadFile]] = File(None), image_ids: Optional[str] = Form(None), k: Optional[int] = Form(None)):
+    if k is not None and k <= 0:
+        return JSONResponse(status_code=400, content={"error": "k must be a positive integer"})
+
+    cluster_set, error = get_cluster_set(cluster)
+    if error is not None:
+        return error
+
+    files = files or []
+    id_paths = [os.path.join("images/segmented", img_id.strip()) for img_id in (image_ids or "").split(",") if img_id.strip()]
+    upload_paths = [os.path.join("images/segmented", file.filename) for file in files]
+    query_paths = upload_paths + id_paths
+    if not query_paths:
+        return JSONResponse(status_code=400, content={"error": "No query images given"})
+    invalid = [path for path in query_paths if path not in all_image_names]
+    if invalid:
+        return JSONResponse(status_code=400, content={"error": "Invalid image input, please use ones from the database", "invalid": invalid})
+
+    contents = [await file.read() for file in files]
+    tau = 0.14 if k is None else None
+
+    chunk_size = max(BATCH_EXTRACTION_CHUNK, -(-len(contents) // MAX_CONCURRENT_QUERIES))
+    chunks = [contents[start:start + chunk_size] for start in range(0, len(contents), chunk_size)]
+    upload_features = []
+    for chunk_result, error in await asyncio.gather(*(run_limited(request, extract_batch_features, chunk) for chunk in chunks)):
+        if error is not None:
+            return error
+        chunk_error, chunk_features = chunk_result
+        if chunk_error is not None:
+            return JSONResponse(status_code=400, content={"error": chunk_error})
+        upload_features.extend(chunk_features)
+
+    batch_result, error = await run_limited(request, run_batch, upload_features, id_paths, tau, k)
+    if error is not None:
+        return error
+    batch_error, batch_results = batch_result
+    if batch_error is not None:
+        return JSONResponse(status_code=400, content={"error": batch_error})
+
+    queries = []
+    for query_path, (fetched_relevant_images, comparisons) in zip(query_paths, batch_results):
+        results, precision, recall = summarize_results(fetched_relevant_images, cluster_set, query_path)
+        queries.append({
+            "query": query_path,
+            "results": results,
+            "precision": precision,
+            "recall": recall,
+            "comparisons": comparisons
+        })
+
+    return {
+        "status": 200,
+        "queries": queries,
+        "method": "exhaustive",
+        "k": k,
+        "precision": float(np.mean([query["precision"] for query in queries])),
+        "recall": float(np.mean([query["recall"] for query in queries])),
+        "comparisons": sum(query["comparisons"] for query in queries)
+    }
+
+# cache and admission counters, plus the cascade's per-stage survivor counts (of this process, so only with thread executors)
+@app.get("/stats")
+def get_stats():
+    stats = {
+        "result_cache": result_cache.stats(),
+        "feature_cache": feature_cache.stats(),
+        "queries": query_limiter.stats()
+    }
+    if BOUND_CASCADE:
+        stats["bound_cascade"] = {"exhaustive": worker_state["cascade"].stats(), "vp_tree": vptree.cascade.stats() if vptree is not None else None}
+    return stats
 
     # NOTES FROM MIDTERM:
 
@@ -0,0 +1,130 @@
+import threading
+
+import numpy as np
+
+from .histogram_intersection import get_histogram_distances
+from .exhaustive import select_results
+from .sparse_histograms import SparseHistograms
+
+'''
+Lower-bound filter cascade in front of the full 512-bin color intersection
+    - distance = 1 - (a * I_color + b * I_lbp) and I_color <= 1, so the 26-bin LBP term alone bounds it from below: 1 - a - b * I_lbp
+    - merging color bins can only raise an intersection (min(x1, y1) + min(x2, y2) <= min(x1 + x2, y1 + y2)),
+      so intersecting coarse 2x2x2 (8 bins) and 4x4x4 (64 bins) color histograms gives upper bounds on I_color
+    - stages, each with a tighter bound than the last: LBP only -> 8 color bins -> 64 color bins -> exact distance
+        - a stage drops every candidate whose lower bound is beyond the search radius (tau, or the k-th distance for knn)
+        - for knn the radius starts as the k-th exact distance among the k candidates with the lowest 8-bin bound
+        - only the survivors of the last stage get the full intersection, computed by get_histogram_distances, so results match it exactly
+    - BoundCascade keeps the coarse color matrices next to the full ones
+        - it counts the candidates and the survivors of every stage across queries (stats())
+        - it works on any contiguous block of rows, so the VP tree uses it to scan its leaves too
+    - comparisons counts exact distance evaluations only, the cheap bounds are reported through stats()
+'''
+
+# coarse histogram resolutions (bins per channel) of the color stages, coarsest first
+COARSE_LEVELS = (2, 4)
+# slack on every bound, so float rounding never drops a candidate that is within the radius
+BOUND_TOLERANCE = 1e-6
+CASCADE_STAGES = ("lbp", "color_8", "color_64")
+
+# merges blocks of neighbouring bins of cubic (e.g. 8x8x8) color histograms into bins_per_channel^3 bins
+#   - color_hists is an N x 512 matrix (dense, memory-mapped or SparseHistograms), converted chunk_size rows at a time
+def coarsen_color_histograms(color_hists, bins_per_channel, chunk_size=65536):
+    n_bins = color_hists.shape[1]
+    fine = int(round(n_bins ** (1 / 3)))
+    if fine ** 3 != n_bins or fine % bins_per_channel != 0:
+        raise ValueError(f"cannot merge {n_bins} color bins into {bins_per_channel}^3 bins")
+    factor = fine // bins_per_channel
+    bins = np.arange(n_bins)
+    channel_0, channel_1, channel_2 = bins // (fine * fine) // factor, bins // fine % fine // factor, bins % fine // factor
+    coarse_bins = (channel_0 * bins_per_channel + channel_1) * bins_per_channel + channel_2
+    n_coarse = bins_per_channel ** 3
+
+    if isinstance(color_hists, SparseHistograms):
+        rows = np.repeat(np.arange(len(color_hists)), np.diff(color_hists.indptr))
+        coarse = np.bincount(rows * n_coarse + coarse_bins[color_hists.indices], weights=color_hists.data, minlength=len(color_hists) * n_coarse)
+        return coarse.reshape(len(color_hists), n_coarse)
+
+    merge = np.zeros((n_bins, n_coarse))
+    merge[bins, coarse_bins] = 1
+    out = np.empty((len(color_hists), n_coarse))
+    for start in range(0, len(color_hists), chunk_size):
+        out[start:start + chunk_size] = np.asarray(color_hists[start:start + chunk_size], dtype=np.float64) @ merge
+    return out
+
+class BoundCascade:
+    def __init__(self, color_matrix, lbp_matrix, a=0.2, b=0.8):
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.coarse_matrices = [coarsen_color_histograms(color_matrix, bins) for bins in COARSE_LEVELS]
+        self.a = a
+        self.b = b
+        self.counts = dict.fromkeys(("queries", "candidates") + CASCADE_STAGES + ("exact",), 0)
+        self._lock = threading.Lock()
+
+    # (color_hist, lbp_hist, coarse color hists) of a query, computed once per search
+    def prepare_query(self, query_feature):
+        color_hist, lbp_hist = query_feature
+        coarse_hists = [coarsen_color_histograms(np.asarray(color_hist)[None, :], bins)[0] for bins in COARSE_LEVELS]
+        return color_hist, lbp_hist, coarse_hists
+
+    def record(self, counts):
+        with self._lock:
+            self.counts["queries"] += 1
+            for stage, count in counts.items():
+                self.counts[stage] += count
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+# empty per-query counts, filled by get_cascade_distances
+def new_counts():
+    return dict.fromkeys(("candidates",) + CASCADE_STAGES + ("exact",), 0)
+
+# distances from a prepared query to the rows start:end, inf for rows whose lower bound is beyond limit
+#   - with k, limit also shrinks to the k-th smallest of k exact distances (see the module notes)
+#   - adds the candidates and per-stage survivors to counts
+def get_cascade_distances(cascade, query, start, end, limit=np.inf, k=None, counts=None):
+    color_hist, lbp_hist, coarse_hists = query
+    a, b = cascade.a, cascade.b
+    distances = np.full(end - start, np.inf)
+    exact = 0
+
+    lbp_intersection = np.minimum(cascade.lbp_matrix[start:end], lbp_hist).sum(axis=1)
+    # the color intersection is at most 1
+    rows = np.flatnonzero(1 - (a + lbp_intersection * b) <= limit + BOUND_TOLERANCE)
+    survivors = [len(rows)]
+
+    for level, (coarse_matrix, coarse_hist) in enumerate(zip(cascade.coarse_matrices, coarse_hists)):
+        coarse_intersection = np.minimum(coarse_matrix[start + rows], coarse_hist).sum(axis=1)
+        bounds = 1 - (coarse_intersection * a + lbp_intersection[rows] * b)
+        if level == 0 and k is not None and 0 < k < len(rows):
+            seeds = rows[np.argpartition(bounds, k - 1)[:k]]
+            distances[seeds] = get_histogram_distances(color_hist, cascade.color_matrix[start + seeds], lbp_hist, cascade.lbp_matrix[start + seeds], a=a, b=b)
+            exact += len(seeds)
+            limit = min(limit, distances[seeds].max())
+        keep = bounds <= limit + BOUND_TOLERANCE
+        rows = rows[keep]
+        survivors.append(len(rows))
+
+    rows = rows[np.isinf(distances[rows])]
+    if len(rows):
+        distances[rows] = get_histogram_distances(color_hist, cascade.color_matrix[start + rows], lbp_hist, cascade.lbp_matrix[start + rows], a=a, b=b)
+    exact += len(rows)
+
+    if counts is not None:
+        counts["candidates"] += int(end - start)
+        for stage, count in zip(CASCADE_STAGES, survivors):
+            counts[stage] += count
+        counts["exact"] += exact
+    return distances
+
+# exhaustive search through the cascade, returns (fetched_relevant_images, exact distance evaluations)
+def search_exhaustive_cascade(names, cascade, query_feature, tau=None, k=None):
+    counts = new_counts()
+    distances = get_cascade_distances(cascade, cascade.prepare_query(query_feature), 0, len(names),
+                                      limit=np.inf if tau is None else tau, k=k, counts=counts)
+    cascade.record(counts)
+    fetched_relevant_images, _ = select_results(names, distances, tau, k)
+    return fetched_relevant_images, counts["exact"]
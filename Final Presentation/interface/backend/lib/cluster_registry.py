@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import threading
+
+import numpy as np
+
+'''
+Registry of the ground truth cluster files, loaded once at startup
+    - every clusters/{name}.json becomes a compact ClusterSet
+        - labels[image index] is the cluster id of each image in the collection (-1 if unlisted)
+        - sizes[cluster id] is the number of images listed in each cluster
+        - cluster_names[cluster id] is the cluster's key in the JSON file
+    - get(name) checks the directory at most once per reload_interval seconds
+        - new, changed or deleted files are picked up without restarting the server
+        - a changed file is parsed into a new ClusterSet which then replaces the old one in one step,
+          so requests never see a half-loaded cluster file
+        - a file that fails to parse keeps its previous ClusterSet
+    - unknown cluster names return None (the API turns that into a 400)
+'''
+
+class ClusterSet:
+    def __init__(self, name, labels, sizes, cluster_names, mtime, size):
+        self.name = name
+        self.labels = labels
+        self.sizes = sizes
+        self.cluster_names = cluster_names
+        self.mtime = mtime
+        self.size = size
+
+def load_cluster_set(name, path, img_to_idx):
+    stat = os.stat(path)
+    with open(path, "r") as f:
+        clusters = json.load(f)["clusters"]
+
+    cluster_names = list(clusters)
+    labels = np.full(len(img_to_idx), -1, dtype=np.int32)
+    sizes = np.zeros(len(cluster_names), dtype=np.int32)
+    for cluster_id, cluster in enumerate(cluster_names):
+        sizes[cluster_id] = len(clusters[cluster])
+        for img in clusters[cluster]:
+            idx = img_to_idx.get(img)
+            if idx is not None:
+                labels[idx] = cluster_id
+    return ClusterSet(name, labels, sizes, cluster_names, stat.st_mtime_ns, stat.st_size)
+
+class ClusterRegistry:
+    def __init__(self, cluster_dir, img_to_idx, reload_interval=1.0):
+        self.cluster_dir = cluster_dir
+        self.img_to_idx = img_to_idx
+        self.reload_interval = reload_interval
+        self.cluster_sets = {}
+        self.version = 0
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def names(self):
+        return sorted(self.cluster_sets)
+
+    # reloads cluster files that were added, changed or removed since the last check
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_check < self.reload_interval:
+            return
+        with self._lock:
+            if not force and now - self._last_check < self.reload_interval:
+                return
+            self._last_check = now
+
+            cluster_sets = dict(self.cluster_sets)
+            found = set()
+            for cluster_file in os.listdir(self.cluster_dir):
+                if not cluster_file.endswith(".json"):
+                    continue
+                name = cluster_file[:-len(".json")]
+                path = os.path.join(self.cluster_dir, cluster_file)
+                found.add(name)
+
+                current = cluster_sets.get(name)
+                # the file can be removed or renamed after listdir, it is then skipped until the next check
+                try:
+                    stat = os.stat(path)
+                    if current is not None and current.mtime == stat.st_mtime_ns and current.size == stat.st_size:
+                        continue
+                    cluster_sets[name] = load_cluster_set(name, path, self.img_to_idx)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Could not load cluster file {path}: {e}")
+
+            for name in set(cluster_sets) - found:
+                del cluster_sets[name]
+
+            if cluster_sets.keys() != self.cluster_sets.keys() or any(cluster_sets[name] is not self.cluster_sets[name] for name in cluster_sets):
+                self.cluster_sets = cluster_sets
+                self.version += 1
+
+    def get(self, name):
+        self.refresh()
+        return self.cluster_sets.get(name)
@@ -0,0 +1,72 @@
+import numpy as np
+
+from .histogram_intersection import get_histogram_distances, get_histogram_distance_matrix
+from .sparse_histograms import SparseHistograms, get_sparse_error_bound
+
+'''
+Matrix-backed exhaustive search
+    - image features are held as two contiguous matrices (N x 512 color, N x 26 LBP)
+    - one batched min-sum computes the distance from the query to all N images at once
+    - tau keeps every image within the similarity radius (boolean mask)
+    - k keeps only the k closest images (argpartition), applied after the tau cut
+    - batches of queries are scored together as one blocked Q x N distance matrix
+    - with a SparseHistograms color matrix the sparse distances only filter candidates, which are rescored
+      on their dense rows (rescore_sparse), so results match dense search exactly
+        - comparisons then counts the sparse distances plus the rescored ones
+'''
+
+# stacks (image_name, (color_hist, lbp_hist)) pairs into contiguous feature matrices
+def build_feature_matrix(images_features):
+    names = [name for name, _ in images_features]
+    color_matrix = np.ascontiguousarray([feature[0] for _, feature in images_features], dtype=np.float32)
+    lbp_matrix = np.ascontiguousarray([feature[1] for _, feature in images_features], dtype=np.float64)
+    return names, color_matrix, lbp_matrix
+
+def search_exhaustive(names, color_matrix, lbp_matrix, query_feature, tau=None, k=None):
+    distances = get_histogram_distances(query_feature[0], color_matrix, query_feature[1], lbp_matrix, a=0.2, b=0.8)
+    if isinstance(color_matrix, SparseHistograms):
+        return rescore_sparse(names, color_matrix, lbp_matrix, query_feature, distances, tau, k)
+    return select_results(names, distances, tau, k)
+
+# exhaustive search for many queries at once, returns one (fetched, comparisons) pair per query
+def search_exhaustive_batch(names, color_matrix, lbp_matrix, query_features, tau=None, k=None):
+    color_queries = np.ascontiguousarray([feature[0] for feature in query_features], dtype=np.float32)
+    lbp_queries = np.ascontiguousarray([feature[1] for feature in query_features], dtype=np.float64)
+    distances = get_histogram_distance_matrix(color_queries, color_matrix, lbp_queries, lbp_matrix, a=0.2, b=0.8)
+    if isinstance(color_matrix, SparseHistograms):
+        return [rescore_sparse(names, color_matrix, lbp_matrix, query_feature, row, tau, k) for query_feature, row in zip(query_features, distances)]
+    return [select_results(names, row, tau, k) for row in distances]
+
+# exact results from sparse distances: every true result is within the error bound of its sparse distance,
+# so only the rows within tau or the k-th distance plus that bound are rescored, on their dense rows
+def rescore_sparse(names, color_matrix, lbp_matrix, query_feature, distances, tau=None, k=None):
+    bound = get_sparse_error_bound(color_matrix.shape[1])
+    limit = tau + bound if tau is not None else np.inf
+    if k is not None and 0 < k < len(distances):
+        limit = min(limit, np.partition(distances, k - 1)[k - 1] + 2 * bound)
+    candidates = np.flatnonzero(distances <= limit)
+
+    rescored = np.full(len(distances), np.inf)
+    rescored[candidates] = get_histogram_distances(query_feature[0], color_matrix[candidates].toarray(), query_feature[1], lbp_matrix[candidates], a=0.2, b=0.8)
+    fetched_relevant_images, _ = select_results(names, rescored, tau, k)
+    return fetched_relevant_images, len(distances) + len(candidates)
+
+# applies the tau cut and top-k selection to one row of query distances
+def select_results(names, distances, tau=None, k=None):
+    comparisons = len(distances)
+
+    # indices are kept in collection order so ties resolve the same way as a linear scan
+    if tau is not None:
+        candidates = np.flatnonzero(distances <= tau)
+    else:
+        candidates = np.arange(comparisons)
+
+    if k is not None and len(candidates) > k:
+        if k <= 0:
+            candidates = candidates[:0]
+        else:
+            nearest = np.argpartition(distances[candidates], k - 1)[:k]
+            candidates = np.sort(candidates[nearest])
+
+    fetched_relevant_images = [(names[i], distances[i]) for i in candidates]
+    return (fetched_relevant_images, comparisons)
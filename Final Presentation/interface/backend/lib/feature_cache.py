@@ -0,0 +1,45 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+'''
+Bounded LRU cache of query features keyed by the content hash of the uploaded bytes
+    - repeat uploads of the same image skip decoding and feature extraction entirely
+    - holds at most max_entries (color_hist, lbp_hist) pairs, evicting the least recently used
+    - cached arrays are made read-only since they are shared between requests
+    - thread-safe, so it can be used from executor threads
+'''
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+class FeatureCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            feature = self.entries.get(key)
+            if feature is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return feature
+
+    def put(self, key, feature):
+        for hist in feature:
+            hist.setflags(write=False)
+        with self._lock:
+            self.entries[key] = feature
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
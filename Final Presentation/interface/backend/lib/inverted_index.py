@@ -0,0 +1,132 @@
+import threading
+
+import numpy as np
+
+from .histogram_intersection import get_histogram_distances
+from .exhaustive import select_results
+from .sparse_histograms import SparseHistograms
+
+'''
+Inverted-file index over color histogram bins
+    - intersection decomposes bin by bin, so every nonzero color bin gets a postings list of (image, weight) pairs,
+      sorted by weight from largest to smallest
+        - postings are stored like a CSR matrix over bins: offsets[bin]:offsets[bin + 1] index posting_ids / posting_weights
+        - only images that share a color bin with the query appear in its lists, the rest add nothing to I_color
+    - the 26 LBP bins are nonzero for almost every image, so their lists would hold the whole collection;
+      the LBP term is taken from the LBP matrix directly (one cheap 26-bin pass) instead
+    - search accumulates min(q, weight) over the query's lists a block of postings at a time, largest weights first
+        - partial color sums only grow, so 1 - (a * partial + b * I_lbp) is an upper bound on every image's distance
+        - the next unread weight of each list caps what the rest of that list can add, so subtracting
+          a * sum(min(q, next weight)) gives a lower bound
+        - images whose lower bound is beyond tau (or the k-th smallest upper bound, for top-k) are out
+        - reading stops early once scoring the images left costs less than reading a further block,
+          and those are scored exactly from the feature matrices (get_histogram_distances), so results match exhaustive search
+        - blocks double in size every round, so a query needs few rounds even when it reads its lists to the end
+    - comparisons counts the images scored exactly, which leaves out reading the postings
+        - the postings read are counted separately, across queries, by stats() (queries, postings, exact)
+          so they can be compared with the distance evaluations of other methods
+'''
+
+# slack on the bounds, so float rounding never drops an image that is within the radius
+BOUND_TOLERANCE = 1e-6
+
+class InvertedIndex:
+    def __init__(self, names, color_matrix, lbp_matrix, offsets, posting_ids, posting_weights, a=0.2, b=0.8):
+        self.names = names
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.offsets = offsets
+        self.posting_ids = posting_ids
+        self.posting_weights = posting_weights
+        self.a = a
+        self.b = b
+        self.counts = {"queries": 0, "postings": 0, "exact": 0}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def record(self, postings, exact):
+        with self._lock:
+            self.counts["queries"] += 1
+            self.counts["postings"] += postings
+            self.counts["exact"] += exact
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+# (bin, image, weight) of every nonzero entry of a histogram matrix, chunk_size rows at a time
+def get_nonzero_entries(hists, chunk_size=65536):
+    if isinstance(hists, SparseHistograms):
+        rows = np.repeat(np.arange(len(hists)), np.diff(hists.indptr))
+        return hists.indices.astype(np.int64), rows, hists.data.astype(np.float64)
+    bins, rows, weights = [], [], []
+    for start in range(0, len(hists), chunk_size):
+        chunk = np.asarray(hists[start:start + chunk_size])
+        chunk_rows, chunk_bins = np.nonzero(chunk)
+        bins.append(chunk_bins)
+        rows.append(chunk_rows + start)
+        weights.append(chunk[chunk_rows, chunk_bins].astype(np.float64))
+    if not bins:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate(bins), np.concatenate(rows), np.concatenate(weights)
+
+# builds the postings of every color bin
+def build_inverted_index(names, color_matrix, lbp_matrix, a=0.2, b=0.8):
+    bins, rows, weights = get_nonzero_entries(color_matrix)
+    # by bin, then by weight from largest to smallest
+    order = np.lexsort((-weights, bins))
+    offsets = np.zeros(color_matrix.shape[1] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(bins, minlength=color_matrix.shape[1]), out=offsets[1:])
+    return InvertedIndex(names, color_matrix, lbp_matrix, offsets, rows[order].astype(np.int32), weights[order], a=a, b=b)
+
+def search_inverted_index(index, query_feature, tau=None, k=None, block_size=64):
+    n = len(index)
+    if n == 0 or (k is not None and k <= 0):
+        return ([], 0)
+    color_hist, lbp_hist = query_feature
+    a, b = index.a, index.b
+
+    query_bins = np.flatnonzero(color_hist)
+    query_weights = np.asarray(color_hist, dtype=np.float64)[query_bins]
+    positions = index.offsets[query_bins].copy()
+    ends = index.offsets[query_bins + 1]
+
+    lbp_intersection = np.minimum(index.lbp_matrix, lbp_hist).sum(axis=1)
+    partial = np.zeros(n)
+    candidates = np.arange(n)
+    postings_read = 0
+
+    while True:
+        # the next block of every list, added to the partial color sums
+        block_ends = np.minimum(positions + block_size, ends)
+        lengths = block_ends - positions
+        block_starts = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=block_starts[1:])
+        postings = np.repeat(positions - block_starts, lengths) + np.arange(lengths.sum())
+        contributions = np.minimum(index.posting_weights[postings], np.repeat(query_weights, lengths))
+        partial += np.bincount(index.posting_ids[postings], weights=contributions, minlength=n)
+        postings_read += len(postings)
+        positions = block_ends
+        block_size *= 2
+
+        remaining = positions < ends
+        next_weights = index.posting_weights[positions[remaining]]
+        unread = np.sum(np.minimum(query_weights[remaining], next_weights))
+
+        upper = 1 - (partial[candidates] * a + lbp_intersection[candidates] * b)
+        limit = np.inf if tau is None else tau
+        if k is not None and k < len(candidates):
+            limit = min(limit, np.partition(upper, k - 1)[k - 1])
+        candidates = candidates[upper - a * unread <= limit + BOUND_TOLERANCE]
+
+        # stop once scoring the images left (about one posting per query bin each) costs less than reading another block
+        if not remaining.any() or len(candidates) * len(query_bins) <= np.sum(np.minimum(ends[remaining] - positions[remaining], block_size)):
+            break
+
+    distances = np.full(n, np.inf)
+    distances[candidates] = get_histogram_distances(color_hist, index.color_matrix[candidates], lbp_hist, index.lbp_matrix[candidates], a=a, b=b)
+    index.record(postings_read, len(candidates))
+    fetched_relevant_images, _ = select_results(index.names, distances, tau, k)
+    return fetched_relevant_images, len(candidates)
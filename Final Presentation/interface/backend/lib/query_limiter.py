@@ -0,0 +1,81 @@
+import asyncio
+
+'''
+Admission control for queries run in an executor
+    - at most max_concurrent queries run at once, which is also the number of executor workers they can occupy
+    - at most max_waiting further queries wait for a slot; beyond that run raises QueueFull (the API answers 503)
+        - a query that waits longer than queue_timeout seconds also raises QueueFull
+    - while a query waits or runs, the client connection is polled every poll_interval seconds
+        - if the client disconnects, a waiting query gives up its place and a query not yet started
+          in the executor is cancelled, then run raises ClientDisconnected
+        - a query already running in the executor finishes, but its result is dropped
+    - a slot is released only when the executor job is done, so abandoned queries cannot oversubscribe the workers
+'''
+
+class QueueFull(Exception):
+    pass
+
+class ClientDisconnected(Exception):
+    pass
+
+class QueryLimiter:
+    def __init__(self, executor, max_concurrent, max_waiting, queue_timeout=None, poll_interval=0.1):
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.disconnected = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    def stats(self):
+        return {"running": self.running, "waiting": self.waiting, "max_concurrent": self.max_concurrent,
+                "max_waiting": self.max_waiting, "rejected": self.rejected, "disconnected": self.disconnected}
+
+    # awaits the awaitable, cancelling it and raising ClientDisconnected if the client goes away first
+    async def _unless_disconnected(self, request, awaitable, timeout=None):
+        task = asyncio.ensure_future(awaitable)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=self.poll_interval)
+            if done:
+                return task.result()
+            # cancel() fails if the task finished while we were polling, then its result is returned instead
+            if request is not None and await request.is_disconnected() and task.cancel():
+                self.disconnected += 1
+                raise ClientDisconnected()
+            # same for the deadline: a semaphore acquired meanwhile must be returned to the caller, not leaked
+            if deadline is not None and loop.time() >= deadline and task.cancel():
+                self.rejected += 1
+                raise QueueFull()
+
+    def _release(self, _future):
+        self.running -= 1
+        self._semaphore.release()
+
+    # runs func(*args) in the executor once a slot is free and returns its result
+    async def run(self, request, func, *args):
+        if self.running + self.waiting >= self.max_concurrent + self.max_waiting:
+            self.rejected += 1
+            raise QueueFull()
+
+        self.waiting += 1
+        try:
+            await self._unless_disconnected(request, self._semaphore.acquire(), timeout=self.queue_timeout)
+        finally:
+            self.waiting -= 1
+
+        loop = asyncio.get_running_loop()
+        self.running += 1
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self.running -= 1
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f))
+        return await self._unless_disconnected(request, asyncio.wrap_future(future))
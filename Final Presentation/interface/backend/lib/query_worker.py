@@ -0,0 +1,141 @@
+import threading
+from functools import partial
+
+import cv2
+import numpy as np
+
+from .histogram_intersection import compute_3d_hist, compute_lbp_hist
+from .vp_tree import search_vptree, knn_search_vptree, load_vptree
+from .exhaustive import search_exhaustive, search_exhaustive_batch
+from .feature_store import open_feature_store
+from .feature_cache import FeatureCache, hash_bytes
+from .quantized_features import open_quantized_store, search_exhaustive_quantized
+from .bound_cascade import BoundCascade, search_exhaustive_cascade
+from .inverted_index import build_inverted_index, search_inverted_index
+from .pivot_table import build_pivot_table, search_pivot_table
+from .ivf_index import build_ivf_index, search_ivf_index
+from .sparse_histograms import choose_color_matrix
+
+'''
+CPU-bound query work, run in an executor instead of on the asyncio event loop
+    - decoding, feature extraction and the search itself all happen here
+    - worker_state holds what every query searches: the feature store, the VP tree, the inverted-file index, the pivot table,
+      the k-means (IVF) lists and the upload feature cache
+        - with quantized uint16 blocks, exhaustive search filters on them and rescores its candidates with the float rows
+        - with a bound cascade, exhaustive search prunes candidates by cheap lower bounds first (see bound_cascade.py)
+        - otherwise exhaustive and batch search scan exhaustive_color, the color matrix in sparse form when it is sparse enough
+          (or when sparse=True), filtering on the sparse kernel and rescoring exactly (see exhaustive.py)
+        - indexes only some methods use (LAZY_INDEXES) are built on their first query, once per process,
+          so startup and every process worker only pay for the methods actually queried
+        - thread executors share the server's own state (set_worker_state is called once at startup)
+        - process executors call init_worker in each worker process, which memory-maps the feature store
+          and the saved VP tree from disk instead of pickling them over
+    - a batch's uploads are extracted in chunks (extract_batch_features), each its own job, then scored together (run_batch)
+    - run_query, extract_batch_features and run_batch return (error, result) so the server can turn errors into responses
+'''
+
+worker_state = {}
+
+# worker_state key -> builder(image_files, color_matrix, lbp_matrix) of the indexes built on first use
+LAZY_INDEXES = {
+    "inverted_index": build_inverted_index,
+    "pivot_table": partial(build_pivot_table, seed=0),
+    "ivf_index": partial(build_ivf_index, seed=0),
+}
+_lazy_index_lock = threading.Lock()
+
+def set_worker_state(image_files, color_matrix, lbp_matrix, vptree, feature_cache, quantized=None, bound_cascade=False, sparse=None):
+    worker_state["image_files"] = image_files
+    worker_state["color_matrix"] = color_matrix
+    worker_state["exhaustive_color"] = choose_color_matrix(color_matrix, sparse=sparse)
+    worker_state["lbp_matrix"] = lbp_matrix
+    worker_state["img_to_idx"] = {img_file: idx for idx, img_file in enumerate(image_files)}
+    worker_state["vptree"] = vptree
+    worker_state["feature_cache"] = feature_cache
+    worker_state["quantized"] = quantized
+    worker_state["cascade"] = BoundCascade(worker_state["color_matrix"], lbp_matrix) if bound_cascade else None
+    for name in LAZY_INDEXES:
+        worker_state[name] = None
+
+# the lazily built index stored under name, built from the worker's features on first use
+def get_lazy_index(name):
+    index = worker_state[name]
+    if index is None:
+        with _lazy_index_lock:
+            index = worker_state[name]
+            if index is None:
+                index = LAZY_INDEXES[name](worker_state["image_files"], worker_state["color_matrix"], worker_state["lbp_matrix"])
+                worker_state[name] = index
+    return index
+
+# initializer for process executors
+def init_worker(store_dir, vptree_index, fingerprint, feature_cache_size=1024, quantized=False, bound_cascade=False, sparse=None):
+    image_files, color_matrix, lbp_matrix = open_feature_store(store_dir)
+    vptree = load_vptree(vptree_index, fingerprint=fingerprint, bound_cascade=bound_cascade)
+    quantized_matrices = open_quantized_store(store_dir)[1:] if quantized else None
+    set_worker_state(image_files, color_matrix, lbp_matrix, vptree, FeatureCache(max_entries=feature_cache_size),
+                     quantized=quantized_matrices, bound_cascade=bound_cascade, sparse=sparse)
+
+# computes query features from an uploaded image's raw bytes, decoded in memory
+#   - returns None if the bytes are not a readable image
+def extract_upload_features(data):
+    feature_cache = worker_state["feature_cache"]
+    key = hash_bytes(data)
+    query_feature = feature_cache.get(key)
+    if query_feature is not None:
+        return query_feature
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    query_feature = (compute_3d_hist(image), compute_lbp_hist(image))
+    feature_cache.put(key, query_feature)
+    return query_feature
+
+# runs one query with the chosen method, returns None for an unknown method
+def run_search(method, query_feature, tau, k):
+    if method == "exhaustive" and worker_state["quantized"] is not None:
+        color_quantized, lbp_quantized = worker_state["quantized"]
+        return search_exhaustive_quantized(worker_state["image_files"], color_quantized, lbp_quantized, query_feature, tau, k,
+                                           exact_matrices=(worker_state["color_matrix"], worker_state["lbp_matrix"]))
+    elif method == "exhaustive" and worker_state["cascade"] is not None:
+        return search_exhaustive_cascade(worker_state["image_files"], worker_state["cascade"], query_feature, tau, k)
+    elif method == "exhaustive":
+        return search_exhaustive(worker_state["image_files"], worker_state["exhaustive_color"], worker_state["lbp_matrix"], query_feature, tau, k)
+    elif method == "vp_tree":
+        if k is None:
+            return search_vptree(worker_state["vptree"], query_feature, tau)
+        return knn_search_vptree(worker_state["vptree"], query_feature, k)
+    elif method == "inverted_file":
+        return search_inverted_index(get_lazy_index("inverted_index"), query_feature, tau, k)
+    elif method == "pivot_table":
+        return search_pivot_table(get_lazy_index("pivot_table"), query_feature, tau, k)
+    elif method == "ivf":
+        return search_ivf_index(get_lazy_index("ivf_index"), query_feature, tau, k)
+    return None
+
+# decodes the upload and searches for it, returns (error, (fetched_relevant_images, comparisons))
+def run_query(data, method, tau, k):
+    query_feature = extract_upload_features(data)
+    if query_feature is None:
+        return "Could not decode uploaded image", None
+    search_result = run_search(method, query_feature, tau, k)
+    if search_result is None:
+        return "Invalid method", None
+    return None, search_result
+
+# decodes one chunk of a batch's uploads, returns (error, query features in upload order)
+def extract_batch_features(contents):
+    upload_features = [extract_upload_features(data) for data in contents]
+    if any(feature is None for feature in upload_features):
+        return "Could not decode uploaded image", None
+    return None, upload_features
+
+# looks up the stored features of the image IDs and scores them together with the extracted upload features,
+# returns (error, [(fetched_relevant_images, comparisons)] in upload then ID order)
+def run_batch(upload_features, id_paths, tau, k):
+    color_matrix = worker_state["color_matrix"]
+    lbp_matrix = worker_state["lbp_matrix"]
+    img_to_idx = worker_state["img_to_idx"]
+    query_features = upload_features + [(color_matrix[img_to_idx[path]], lbp_matrix[img_to_idx[path]]) for path in id_paths]
+    return None, search_exhaustive_batch(worker_state["image_files"], worker_state["exhaustive_color"], lbp_matrix, query_features, tau, k)
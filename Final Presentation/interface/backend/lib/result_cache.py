@@ -0,0 +1,81 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+'''
+LRU/TTL cache of finished query responses
+    - keyed by whatever identifies a query, e.g. (upload hash, method, tau, k, cluster file)
+    - every lookup passes the current index version (feature store, VP tree and cluster files)
+        - when the version changes, every cached response is dropped, so stale results are never served
+    - entries older than ttl seconds are treated as misses and removed
+    - the total estimated size of the cached responses stays within max_bytes, evicting the least recently used
+    - counts hits, misses, expirations and evictions
+'''
+
+# rough size in bytes of a JSON-like response (dicts, lists, strings, numbers)
+def estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(v) for v in value)
+    return size
+
+class ResultCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.version = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.bytes = 0
+            self.version = version
+
+    def get(self, key, version):
+        with self._lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, created = entry
+            if self.ttl is not None and time.monotonic() - created > self.ttl:
+                del self.entries[key]
+                self.bytes -= size
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, version, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._check_version(version)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size, time.monotonic())
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "expired": self.expired, "evicted": self.evicted}
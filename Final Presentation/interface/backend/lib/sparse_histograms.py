@@ -0,0 +1,145 @@
+import numpy as np
+
+'''
+Sparse (CSR) storage for color histograms
+    - segmented parasites sit on a white background, so most of the 512 color bins are zero for every image
+    - SparseHistograms keeps only the nonzero bins of each row: data (float32 values), indices (bin numbers)
+      and indptr (row offsets), like a CSR matrix
+        - rows are selected like a NumPy matrix: an int gives a dense row, a slice or an index array gives a SparseHistograms
+    - get_sparse_intersections intersects a dense query with every row by touching only the rows' nonzero bins
+        - per-row sums are accumulated in float64 and in another order than the dense float32 min-sum,
+          so distances differ from it in the last bits (up to about 3e-8): an image's distance to itself can be 1e-9
+          instead of exactly 0, and an image right at a radius can fall on the other side of it
+    - exhaustive search stays exact on sparse rows: the sparse distances only filter candidates (within tau or the k-th
+      distance plus get_sparse_error_bound), and the survivors are rescored on their dense rows, rebuilt bit for bit
+      from the stored values (see exhaustive.py)
+        - the distance matrix and the VP tree need every distance they compute, so they stay dense unless asked otherwise
+    - choose_color_matrix decides from the measured density by default: sparse when it is at most SPARSE_DENSITY_THRESHOLD
+        - whole-collection scans (exhaustive search) go sparse only from SPARSE_MIN_SEARCH_ROWS images up,
+          below that the rescoring costs more than the sparse kernel saves
+        - sparse=True / False forces either form
+        - the sparse kernel only wins when one call scans enough rows, so callers that scan small blocks
+          (VP tree leaves) pass block_rows and stay dense below SPARSE_MIN_ROWS
+        - get_histogram_distances / get_histogram_distance_matrix use the sparse kernel whenever they are given a SparseHistograms,
+          but only exhaustive search rescores: a VP tree or index forced onto sparse rows returns the sparse distances
+'''
+
+# at or below this fraction of nonzero bins the sparse kernel is faster than the dense min-sum
+# (they break even at about 0.3 on a 20000 x 512 matrix, the segmented parasites are at about 0.05)
+SPARSE_DENSITY_THRESHOLD = 0.25
+# fewest rows per kernel call for which the sparse kernel is faster (break even at about 64 rows)
+SPARSE_MIN_ROWS = 128
+# fewest images for which the sparse filter plus the dense rescore beats a dense exhaustive scan
+# (break even at about 1000 images for a radius search, top-k breaks even sooner since it rescores only about k rows)
+SPARSE_MIN_SEARCH_ROWS = 1024
+
+class SparseHistograms:
+    def __init__(self, data, indices, indptr, n_bins):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.n_bins = n_bins
+        self.shape = (len(indptr) - 1, n_bins)
+        self.dtype = data.dtype
+        # row starts of the non-empty rows, for np.add.reduceat
+        self._nonempty = indptr[1:] > indptr[:-1]
+        self._starts = indptr[:-1][self._nonempty]
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def density(self):
+        return self.nnz / (self.shape[0] * self.shape[1]) if self.shape[0] * self.shape[1] > 0 else 0.0
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            row = np.zeros(self.n_bins, dtype=self.dtype)
+            start, end = self.indptr[key], self.indptr[key + 1]
+            row[self.indices[start:end]] = self.data[start:end]
+            return row
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                first, last = self.indptr[start], self.indptr[max(start, stop)]
+                return SparseHistograms(self.data[first:last], self.indices[first:last],
+                                        self.indptr[start:max(start, stop) + 1] - first, self.n_bins)
+            key = np.arange(start, stop, step)
+        return take_rows(self, np.asarray(key))
+
+    def toarray(self):
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        dense[rows, self.indices] = self.data
+        return dense
+
+# rows of a SparseHistograms in the given order (an index array or boolean mask)
+def take_rows(sparse, rows):
+    if rows.dtype == bool:
+        rows = np.flatnonzero(rows)
+    starts = sparse.indptr[rows]
+    lengths = sparse.indptr[rows + 1] - starts
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    # position of every kept entry in the source arrays
+    positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+    return SparseHistograms(sparse.data[positions], sparse.indices[positions], indptr, sparse.n_bins)
+
+# converts a dense (possibly memory-mapped) histogram matrix, chunk_size rows at a time
+def to_sparse_histograms(matrix, chunk_size=65536):
+    data = []
+    indices = []
+    counts = []
+    for start in range(0, len(matrix), chunk_size):
+        chunk = np.asarray(matrix[start:start + chunk_size])
+        rows, cols = np.nonzero(chunk)
+        data.append(chunk[rows, cols])
+        indices.append(cols.astype(np.uint16 if matrix.shape[1] <= 65536 else np.int64))
+        counts.append(np.bincount(rows, minlength=len(chunk)))
+    indptr = np.zeros(len(matrix) + 1, dtype=np.int64)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+    dtype = matrix.dtype
+    return SparseHistograms(np.concatenate(data).astype(dtype) if data else np.zeros(0, dtype=dtype),
+                            np.concatenate(indices) if indices else np.zeros(0, dtype=np.uint16), indptr, matrix.shape[1])
+
+# fraction of nonzero bins, measured on at most sample_rows evenly spaced rows
+def get_density(matrix, sample_rows=10000):
+    if isinstance(matrix, SparseHistograms):
+        return matrix.density
+    if len(matrix) == 0:
+        return 1.0
+    rows = np.unique(np.linspace(0, len(matrix) - 1, min(sample_rows, len(matrix))).astype(np.int64))
+    return np.count_nonzero(np.asarray(matrix[rows])) / (len(rows) * matrix.shape[1])
+
+# color matrix in sparse or dense form
+#   - sparse=None decides from the measured density and from block_rows,
+#     the number of rows a typical kernel call scans (None for whole-matrix scans)
+#   - sparse=True / False forces either form
+def choose_color_matrix(color_matrix, sparse=None, threshold=SPARSE_DENSITY_THRESHOLD, block_rows=None):
+    if sparse is None:
+        enough_rows = len(color_matrix) >= SPARSE_MIN_SEARCH_ROWS if block_rows is None else block_rows >= SPARSE_MIN_ROWS
+        sparse = enough_rows and get_density(color_matrix) <= threshold
+    if sparse and not isinstance(color_matrix, SparseHistograms):
+        return to_sparse_histograms(color_matrix)
+    if not sparse and isinstance(color_matrix, SparseHistograms):
+        return color_matrix.toarray()
+    return color_matrix
+
+# largest difference between a sparse and a dense distance
+#   - each kernel sums at most n_bins terms of at most 1 in total, so its rounding error is below n_bins float32 epsilons
+#     (the dense float32 sum, in any order), plus one more for scaling by a and the final sum
+def get_sparse_error_bound(n_bins, a=0.2):
+    return a * (n_bins + 2) * float(np.finfo(np.float32).eps)
+
+# sum of min(hist, row) over the nonzero bins of every row
+def get_sparse_intersections(hist, sparse):
+    out = np.zeros(len(sparse), dtype=np.float64)
+    if sparse.nnz > 0:
+        values = np.minimum(sparse.data, hist[sparse.indices])
+        out[sparse._nonempty] = np.add.reduceat(values, sparse._starts, dtype=np.float64)
+    return out
@@ -6,6 +6,9 @@ import { useState } from "react";
 const backend_methods = {
     "Exhaustive Search": "exhaustive",
     "VPTree Search": "vp_tree",
+    "Inverted File Search": "inverted_file",
+    "Pivot Table Search": "pivot_table",
+    "IVF Search": "ivf",
 };
 
 const backend_clusters = {
@@ -28,6 +31,7 @@ interface Result {
     status: number;
     results: Result_Image[];
     method: string;
+    k: number | null;
     precision: number;
     recall: number;
     comparisons: number;
@@ -36,12 +40,14 @@ interface Result {
 export default function Home() {
     const [selectedMethod, setSelectedMethod] = useState(methods[0]);
     const [selectedCluster, setSelectedCluster] = useState(clusters[0]);
+    const [k, setK] = useState("");
     const [uploadedImage, setUploadedImage] = useState<File | null>(null);
     const [previewUrl, setPreviewUrl] = useState<string | null>(null);
     const [results, setResults] = useState<Result>({
         status: 0,
         results: [],
         method: "",
+        k: null,
         precision: 0,
         recall: 0,
         comparisons: 0,
@@ -55,6 +61,10 @@ export default function Home() {
         setSelectedCluster(event.target.value);
     };
 
+    const handleKChange = (event: React.ChangeEvent<HTMLInputElement>) => {
+        setK(event.target.value);
+    };
+
     const handleImageUpload = (e: React.ChangeEvent<HTMLInputElement>) => {
         if (e.target.files && e.target.files[0]) {
             const file = e.target.files[0];
@@ -74,6 +84,9 @@ export default function Home() {
         formData.append("method", backend_methods[selectedMethod as keyof typeof backend_methods]);
         formData.append("cluster", backend_clusters[selectedCluster as keyof typeof backend_clusters]);
         formData.append("file", uploadedImage);
+        if (k !== "") {
+            formData.append("k", k);
+        }
 
         try {
             const res = await fetch("http://localhost:8000/query", {
@@ -121,6 +134,17 @@ export default function Home() {
                             ))}
                         </select>
                     </label>
+                    <label className="flex flex-row gap-2 items-baseline">
+                        <p>Nearest Neighbours (k):</p>
+                        <input
+                            type="number"
+                            min={1}
+                            placeholder="Radius search"
+                            className="border border-zinc-300 rounded-lg p-2 w-48 mb-4"
+                            value={k}
+                            onChange={handleKChange}
+                        />
+                    </label>
                     <label>
                         <input type="file" accept="image/*" className="hidden" onChange={handleImageUpload} />
                         <div className="border-2 border-dashed border-zinc-300 rounded-lg w-80 h-80 flex flex-col items-center justify-center cursor-pointer hover:border-zinc-500">
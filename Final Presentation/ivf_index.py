@@ -0,0 +1,117 @@
+import numpy as np
+from sklearn.cluster import KMeans
+
+from histogram_intersection import get_histogram_distances
+from exhaustive import select_results
+from weighted_l1 import embed_matrix
+
+'''
+Inverted cluster-partitioned (IVF) index over k-means lists
+    - k-means (as in cluster.py) runs on the combined [a * color_hist, b * lbp_hist] vectors and splits the collection into n_lists lists
+        - rows are stored grouped by list in contiguous blocks (offsets[j]:offsets[j + 1] of the reordered matrices)
+        - each list's centroid is the mean of its members' histograms, itself a normalized histogram,
+          so histogram distances to it obey the triangle inequality
+        - each list's radius is the largest distance from a member to the centroid
+    - a query ranks the centroids by histogram distance, then scans whole lists
+        - nprobe=n scans only the n closest lists: cheaper, but neighbours in other lists are missed (tunable recall)
+        - nprobe=None is exact: no member of list j is closer than d(q, centroid_j) - radius_j, so lists are visited
+          by that lower bound and the scan stops at the first one beyond tau (or the k-th distance found so far, for top-k)
+    - distances are mapped back to collection order before select_results, so ties resolve like a linear scan
+        - only rows of scanned lists are selected from, so with nprobe a top-k query returns fewer than k images
+          when the probed lists hold fewer than k, never unscanned rows at an infinite distance
+    - comparisons counts the centroid distances plus the rows scanned
+'''
+
+# lists per index, as many as the k-means ground truth clusters in cluster.py
+IVF_LISTS = 12
+# slack on the lower bounds, so float rounding never skips a list that holds an image within the radius
+BOUND_TOLERANCE = 1e-6
+
+class IVFIndex:
+    def __init__(self, names, order, offsets, color_matrix, lbp_matrix, centroid_color, centroid_lbp, radii, a=0.2, b=0.8):
+        self.names = names
+        self.order = order
+        self.offsets = offsets
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.centroid_color = centroid_color
+        self.centroid_lbp = centroid_lbp
+        self.radii = radii
+        self.a = a
+        self.b = b
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def n_lists(self):
+        return len(self.radii)
+
+def build_ivf_index(names, color_matrix, lbp_matrix, n_lists=IVF_LISTS, seed=0, a=0.2, b=0.8):
+    n = len(names)
+    n_lists = min(n_lists, n)
+    n_color = color_matrix.shape[1]
+    embedded = embed_matrix(color_matrix, lbp_matrix, a=a, b=b)
+    labels = KMeans(n_clusters=n_lists, random_state=seed).fit_predict(embedded) if n > 0 else np.zeros(0, dtype=np.int64)
+
+    # group the rows of every list together
+    order = np.argsort(labels, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+    color_matrix = color_matrix[order]
+    lbp_matrix = np.asarray(lbp_matrix[order])
+    embedded = embedded[order]
+
+    centroid_color = np.zeros((n_lists, n_color), dtype=np.float32)
+    centroid_lbp = np.zeros((n_lists, lbp_matrix.shape[1]))
+    radii = np.full(n_lists, -np.inf)
+    for j in range(n_lists):
+        start, end = offsets[j], offsets[j + 1]
+        if start == end:
+            continue
+        centroid = embedded[start:end].mean(axis=0)
+        centroid_color[j] = centroid[:n_color] / a
+        centroid_lbp[j] = centroid[n_color:] / b
+        radii[j] = get_histogram_distances(centroid_color[j], color_matrix[start:end], centroid_lbp[j], lbp_matrix[start:end], a=a, b=b).max()
+    return IVFIndex(list(names), order, offsets, color_matrix, lbp_matrix, centroid_color, centroid_lbp, radii, a=a, b=b)
+
+def search_ivf_index(index, query_feature, tau=None, k=None, nprobe=None):
+    n = len(index)
+    if n == 0 or (k is not None and k <= 0):
+        return ([], 0)
+    color_hist, lbp_hist = query_feature
+    a, b = index.a, index.b
+
+    centroid_distances = get_histogram_distances(color_hist, index.centroid_color, lbp_hist, index.centroid_lbp, a=a, b=b)
+    comparisons = index.n_lists
+    if nprobe is None:
+        lower = centroid_distances - index.radii
+        lists = np.argsort(lower, kind="stable")
+    else:
+        lower = np.full(index.n_lists, -np.inf)
+        lists = np.argsort(centroid_distances, kind="stable")[:nprobe]
+
+    limit = np.inf if tau is None else tau
+    distances = np.full(n, np.inf)
+    nearest = np.zeros(0)
+    for j in lists:
+        # lists are in lower-bound order, so every list left is beyond the radius too
+        if lower[j] > limit + BOUND_TOLERANCE:
+            break
+        start, end = index.offsets[j], index.offsets[j + 1]
+        if start == end:
+            continue
+        distances[start:end] = get_histogram_distances(color_hist, index.color_matrix[start:end], lbp_hist, index.lbp_matrix[start:end], a=a, b=b)
+        comparisons += int(end - start)
+        if k is not None:
+            nearest = np.concatenate([nearest, distances[start:end]])
+            if len(nearest) >= k:
+                nearest = np.partition(nearest, k - 1)[:k]
+                limit = min(limit, nearest.max())
+
+    # back to collection order, keeping only the rows that were scored
+    collection_distances = np.empty(n)
+    collection_distances[index.order] = distances
+    scored = np.flatnonzero(np.isfinite(collection_distances))
+    fetched_relevant_images, _ = select_results([index.names[i] for i in scored], collection_distances[scored], tau, k)
+    return fetched_relevant_images, comparisons
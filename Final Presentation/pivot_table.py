@@ -0,0 +1,127 @@
+import numpy as np
+
+from histogram_intersection import get_histogram_distances
+from exhaustive import select_results
+from sparse_histograms import SparseHistograms, to_sparse_histograms
+
+'''
+Pivot table (LAESA) index
+    - distance = a * (1 - I_color) + b * (1 - I_lbp) is a weighted sum of half-L1 distances on normalized histograms, so it is a metric
+    - n_pivots images are chosen as pivots by farthest-first traversal (each new pivot is the image farthest from the pivots so far),
+      starting from a seeded random image
+    - the table holds the distance from every image to every pivot (N x n_pivots, float32)
+        - computing the distances to a pivot is one vectorized pass over the collection, which also picks the next pivot
+    - triangle inequality: d(q, x) >= |d(q, p) - d(x, p)| for every pivot p, so max over pivots is a lower bound on d(q, x)
+        - a query computes its n_pivots pivot distances, then the lower bound of every image in one vectorized pass
+        - radius search scores exactly only the images whose lower bound is within tau
+        - top-k search scores images in order of their lower bound, in blocks, until the next bound is beyond the k-th distance
+        - exact scores come from get_histogram_distances, so results match exhaustive search
+    - latency is flat: every query does the same table pass, with no deep tree to walk
+    - the pivots' features are kept in the table, so images can be added (add_images) or removed (remove_images)
+      without touching the pivots or the other rows
+    - comparisons counts the pivot distances plus the images scored exactly
+'''
+
+# pivots per table (on 20000 images, 16 pivots leave about 400 exact scores per top-10 query)
+PIVOT_COUNT = 16
+# slack on the lower bounds, covering float32 table entries and float rounding
+BOUND_TOLERANCE = 1e-6
+
+class PivotTable:
+    def __init__(self, names, color_matrix, lbp_matrix, pivot_color, pivot_lbp, table, seed=None):
+        self.names = names
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.pivot_color = pivot_color
+        self.pivot_lbp = pivot_lbp
+        self.table = table
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def n_pivots(self):
+        return len(self.pivot_color)
+
+# distances from every row of the feature matrices to one pivot
+def get_pivot_column(pivot_color, pivot_lbp, color_matrix, lbp_matrix):
+    return get_histogram_distances(pivot_color, color_matrix, pivot_lbp, lbp_matrix, a=0.2, b=0.8)
+
+def build_pivot_table(names, color_matrix, lbp_matrix, n_pivots=PIVOT_COUNT, seed=None):
+    n = len(names)
+    n_pivots = min(n_pivots, n)
+    table = np.empty((n, n_pivots), dtype=np.float32)
+    pivot_rows = []
+    nearest_pivot = np.full(n, np.inf)
+    row = np.random.RandomState(seed).randint(n) if n > 0 else 0
+
+    for p in range(n_pivots):
+        pivot_rows.append(row)
+        column = get_pivot_column(color_matrix[row], lbp_matrix[row], color_matrix, lbp_matrix)
+        table[:, p] = column
+        # the next pivot is the image farthest from every pivot so far
+        np.minimum(nearest_pivot, column, out=nearest_pivot)
+        row = int(np.argmax(nearest_pivot))
+
+    pivot_color = np.array([color_matrix[row] for row in pivot_rows], dtype=np.float32).reshape(len(pivot_rows), color_matrix.shape[1])
+    pivot_lbp = np.array([lbp_matrix[row] for row in pivot_rows], dtype=np.float64).reshape(len(pivot_rows), lbp_matrix.shape[1])
+    return PivotTable(list(names), color_matrix, lbp_matrix, pivot_color, pivot_lbp, table, seed=seed)
+
+# appends images to the table, computing only their distances to the pivots
+def add_images(pivot_table, names, color_matrix, lbp_matrix):
+    columns = [get_pivot_column(pivot_table.pivot_color[p], pivot_table.pivot_lbp[p], color_matrix, lbp_matrix) for p in range(pivot_table.n_pivots)]
+    rows = np.array(columns, dtype=np.float32).T.reshape(len(names), pivot_table.n_pivots)
+    pivot_table.names = pivot_table.names + list(names)
+    if isinstance(pivot_table.color_matrix, SparseHistograms):
+        new_color = to_sparse_histograms(np.asarray(color_matrix))
+        old = pivot_table.color_matrix
+        pivot_table.color_matrix = SparseHistograms(np.concatenate([old.data, new_color.data]), np.concatenate([old.indices, new_color.indices]),
+                                                    np.concatenate([old.indptr, new_color.indptr[1:] + old.indptr[-1]]), old.n_bins)
+    else:
+        pivot_table.color_matrix = np.concatenate([pivot_table.color_matrix, np.asarray(color_matrix, dtype=pivot_table.color_matrix.dtype)])
+    pivot_table.lbp_matrix = np.concatenate([pivot_table.lbp_matrix, np.asarray(lbp_matrix, dtype=pivot_table.lbp_matrix.dtype)])
+    pivot_table.table = np.concatenate([pivot_table.table, rows])
+
+# drops the given images from the table, the pivots stay as they are
+def remove_images(pivot_table, names):
+    names = set(names)
+    keep = np.array([name not in names for name in pivot_table.names], dtype=bool)
+    pivot_table.names = [name for name in pivot_table.names if name not in names]
+    pivot_table.color_matrix = pivot_table.color_matrix[keep]
+    pivot_table.lbp_matrix = pivot_table.lbp_matrix[keep]
+    pivot_table.table = pivot_table.table[keep]
+
+def search_pivot_table(pivot_table, query_feature, tau=None, k=None, block_size=64):
+    n = len(pivot_table)
+    if n == 0 or (k is not None and k <= 0):
+        return ([], 0)
+    color_hist, lbp_hist = query_feature
+
+    query_pivot = get_histogram_distances(color_hist, pivot_table.pivot_color, lbp_hist, pivot_table.pivot_lbp, a=0.2, b=0.8)
+    lower = np.abs(pivot_table.table - query_pivot.astype(np.float32)).max(axis=1) if pivot_table.n_pivots else np.zeros(n, dtype=np.float32)
+    limit = np.inf if tau is None else tau
+    candidates = np.flatnonzero(lower <= limit + BOUND_TOLERANCE)
+    distances = np.full(n, np.inf)
+    comparisons = pivot_table.n_pivots
+
+    if k is None:
+        distances[candidates] = get_histogram_distances(color_hist, pivot_table.color_matrix[candidates], lbp_hist, pivot_table.lbp_matrix[candidates], a=0.2, b=0.8)
+        comparisons += len(candidates)
+    else:
+        # closest lower bounds first, until the next bound is beyond the k-th distance found so far
+        candidates = candidates[np.argsort(lower[candidates], kind="stable")]
+        start = 0
+        while start < len(candidates):
+            block = candidates[start:start + max(block_size, k)]
+            distances[block] = get_histogram_distances(color_hist, pivot_table.color_matrix[block], lbp_hist, pivot_table.lbp_matrix[block], a=0.2, b=0.8)
+            comparisons += len(block)
+            start += len(block)
+            scored = candidates[:start]
+            if len(scored) >= k:
+                limit = min(limit, np.partition(distances[scored], k - 1)[k - 1])
+            if start < len(candidates) and lower[candidates[start]] > limit + BOUND_TOLERANCE:
+                break
+
+    fetched_relevant_images, _ = select_results(pivot_table.names, distances, tau, k)
+    return fetched_relevant_images, comparisons
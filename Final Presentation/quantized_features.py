@@ -0,0 +1,130 @@
+import os
+import json
+
+import numpy as np
+
+from histogram_intersection import get_histogram_distances, get_histogram_distance_matrix
+from feature_store import open_feature_store, get_store_fingerprint
+from exhaustive import select_results
+
+'''
+Compact fixed-point copy of the feature store with integer histogram intersection
+    - every normalized histogram bin h is stored as round(h * QUANTIZE_SCALE) in a uint16
+        - 538 bins x 2 bytes = 1076 bytes per image, against 2256 bytes for float32 color + float64 LBP
+    - intersection is an integer min-sum (accumulated in uint32, so it is exact for the stored values)
+        - normalization is folded in at the end: distance = 1 - (a * color_sum + b * lbp_sum) / QUANTIZE_SCALE
+    - rounding moves each bin by at most 0.5 / QUANTIZE_SCALE, so a distance can move by at most
+      (a * 512 + b * 26) * 0.5 / QUANTIZE_SCALE (about 0.001), and in practice by far less since few color bins are nonzero
+        - check_parity measures the actual difference from the float path (max/mean error, flipped tau decisions, top-k overlap)
+    - exact search: given the float matrices too, the quantized distances only filter candidates (within tau or the k-th
+      distance plus the error bound) and the survivors are rescored with the float path, so results match it exactly
+    - saved next to the float blocks (color_q16.npy, lbp_q16.npy and quantized.json) and rebuilt when the store's fingerprint changes
+'''
+
+QUANTIZE_SCALE = 65535
+QUANTIZED_COLOR_FILE = "color_q16.npy"
+QUANTIZED_LBP_FILE = "lbp_q16.npy"
+QUANTIZED_META_FILE = "quantized.json"
+
+def quantize_histograms(hists, scale=QUANTIZE_SCALE):
+    return np.rint(np.asarray(hists, dtype=np.float64) * scale).astype(np.uint16)
+
+# integer distances from one quantized query to every quantized row
+def get_quantized_distances(color_hist, color_hists, lbp_hist, lbp_hists, a=0.2, b=0.8, scale=QUANTIZE_SCALE):
+    color_sum = np.minimum(color_hists, color_hist).sum(axis=1, dtype=np.uint32)
+    lbp_sum = np.minimum(lbp_hists, lbp_hist).sum(axis=1, dtype=np.uint32)
+    distances = 1 - (color_sum * a + lbp_sum * b) / scale
+    np.clip(distances, 0, 1, out=distances)
+    return distances
+
+# Q x N quantized distance matrix, in query_block x item_block tiles like get_histogram_distance_matrix
+def get_quantized_distance_matrix(color_queries, color_hists, lbp_queries, lbp_hists, a=0.2, b=0.8, scale=QUANTIZE_SCALE, query_block=16, item_block=512):
+    out = np.empty((len(color_queries), len(color_hists)), dtype=np.float64)
+    for q_start in range(0, len(color_queries), query_block):
+        q_end = min(q_start + query_block, len(color_queries))
+        color_q = color_queries[q_start:q_end, None, :]
+        lbp_q = lbp_queries[q_start:q_end, None, :]
+        for i_start in range(0, len(color_hists), item_block):
+            i_end = min(i_start + item_block, len(color_hists))
+            color_sum = np.minimum(color_hists[None, i_start:i_end, :], color_q).sum(axis=2, dtype=np.uint32)
+            lbp_sum = np.minimum(lbp_hists[None, i_start:i_end, :], lbp_q).sum(axis=2, dtype=np.uint32)
+            out[q_start:q_end, i_start:i_end] = np.clip(1 - (color_sum * a + lbp_sum * b) / scale, 0, 1)
+    return out
+
+# largest difference between a quantized and a float distance
+def get_quantization_error_bound(n_color_bins, n_lbp_bins, a=0.2, b=0.8, scale=QUANTIZE_SCALE):
+    return (a * n_color_bins + b * n_lbp_bins) * 0.5 / scale + 1e-12
+
+# exhaustive search over the quantized rows, the query is quantized on the fly
+#   - exact_matrices=(color_matrix, lbp_matrix) of float rows rescores the candidates exactly,
+#     comparisons then counts the integer distances plus the rescored ones
+def search_exhaustive_quantized(names, color_matrix, lbp_matrix, query_feature, tau=None, k=None, scale=QUANTIZE_SCALE, exact_matrices=None):
+    distances = get_quantized_distances(quantize_histograms(query_feature[0], scale), color_matrix,
+                                        quantize_histograms(query_feature[1], scale), lbp_matrix, a=0.2, b=0.8, scale=scale)
+    if exact_matrices is None:
+        return select_results(names, distances, tau, k)
+
+    # every true result is within the error bound of its quantized distance
+    bound = get_quantization_error_bound(color_matrix.shape[1], lbp_matrix.shape[1], scale=scale)
+    limit = tau + bound if tau is not None else np.inf
+    if k is not None and 0 < k < len(distances):
+        limit = min(limit, np.partition(distances, k - 1)[k - 1] + 2 * bound)
+    candidates = np.flatnonzero(distances <= limit)
+
+    color_exact, lbp_exact = exact_matrices
+    rescored = np.full(len(distances), np.inf)
+    rescored[candidates] = get_histogram_distances(query_feature[0], color_exact[candidates], query_feature[1], lbp_exact[candidates], a=0.2, b=0.8)
+    fetched_relevant_images, _ = select_results(names, rescored, tau, k)
+    return fetched_relevant_images, len(distances) + len(candidates)
+
+def bytes_per_image(*matrices):
+    return sum(matrix.itemsize * (matrix.shape[1] if matrix.ndim > 1 else 1) for matrix in matrices)
+
+# quantizes the float blocks of store_dir into uint16 blocks, chunk_size rows at a time
+def save_quantized_store(store_dir, scale=QUANTIZE_SCALE, chunk_size=65536):
+    _, color_matrix, lbp_matrix = open_feature_store(store_dir)
+    paths = {name: os.path.join(store_dir, name) for name in (QUANTIZED_COLOR_FILE, QUANTIZED_LBP_FILE)}
+    for name, matrix in ((QUANTIZED_COLOR_FILE, color_matrix), (QUANTIZED_LBP_FILE, lbp_matrix)):
+        tmp_path = paths[name].replace(".npy", ".tmp.npy")
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint16, shape=matrix.shape)
+        for start in range(0, len(matrix), chunk_size):
+            out[start:start + chunk_size] = quantize_histograms(matrix[start:start + chunk_size], scale)
+        out.flush()
+        del out
+        os.replace(tmp_path, paths[name])
+    with open(os.path.join(store_dir, QUANTIZED_META_FILE), "w") as f:
+        json.dump({"fingerprint": get_store_fingerprint(store_dir), "scale": scale}, f, indent=4)
+
+# opens the quantized blocks of store_dir (memory-mapped), building them first if missing or stale
+def open_quantized_store(store_dir, scale=QUANTIZE_SCALE):
+    meta_path = os.path.join(store_dir, QUANTIZED_META_FILE)
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    if meta is None or meta.get("fingerprint") != get_store_fingerprint(store_dir) or meta.get("scale") != scale:
+        save_quantized_store(store_dir, scale=scale)
+
+    image_files, _, _ = open_feature_store(store_dir)
+    color_matrix = np.asarray(np.load(os.path.join(store_dir, QUANTIZED_COLOR_FILE), mmap_mode="r"))
+    lbp_matrix = np.asarray(np.load(os.path.join(store_dir, QUANTIZED_LBP_FILE), mmap_mode="r"))
+    return image_files, color_matrix, lbp_matrix
+
+# compares the quantized distances of the query rows against the float path
+def check_parity(color_matrix, lbp_matrix, color_q, lbp_q, query_rows, tau=0.14, k=10, scale=QUANTIZE_SCALE):
+    exact = get_histogram_distance_matrix(color_matrix[query_rows], color_matrix, lbp_matrix[query_rows], lbp_matrix, a=0.2, b=0.8)
+    quantized = get_quantized_distance_matrix(color_q[query_rows], color_q, lbp_q[query_rows], lbp_q, a=0.2, b=0.8, scale=scale)
+    error = np.abs(quantized - exact)
+
+    k = min(k, exact.shape[1])
+    exact_top = np.argsort(exact, axis=1, kind="stable")[:, :k]
+    quantized_top = np.argsort(quantized, axis=1, kind="stable")[:, :k]
+    overlap = [len(np.intersect1d(e, q)) / k for e, q in zip(exact_top, quantized_top)] if k > 0 else [1.0]
+    return {
+        "max_error": float(error.max()) if error.size else 0.0,
+        "mean_error": float(error.mean()) if error.size else 0.0,
+        "error_bound": get_quantization_error_bound(color_matrix.shape[1], lbp_matrix.shape[1], scale=scale),
+        "tau_flips": int(np.count_nonzero((exact <= tau) != (quantized <= tau))),
+        "pairs": int(error.size),
+        "topk_overlap": float(np.mean(overlap)),
+    }
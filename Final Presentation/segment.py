@@ -1,13 +1,14 @@
 import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import skimage as ski
 from skimage.feature import peak_local_max
 from skimage.segmentation import watershed
 from skimage.filters import threshold_otsu, gaussian
-from skimage.measure import regionprops
 from scipy import ndimage as ndi
 import numpy as np
-import matplotlib.pyplot as plt
 
 '''
 Script to segment images of parasites into individual parasite images
@@ -15,65 +16,125 @@ Script to segment images of parasites into individual parasite images
     - apply distance transform and watershed algorithm to segment individual parasites
     - removes objects that are too small or too large based on size thresholds
         - removes noise and darker background regions
+        - region areas come from one bincount over the label image, and a label lookup table
+          relabels every pixel in a single pass
+    - each parasite is masked and cropped inside its own bounding box only
+    - raw images are read once and segmented in parallel across a process pool
+    - reports per-stage timings (threshold, EDT, peaks, watershed, crop, save)
     - saves segmented parasites to "images/segmented" directory
     - output used for clustering and histogram intersection-based search
 '''
 
 raw_image_dir = "images/raw"
-raw_image_files = [os.path.join(raw_image_dir, f) for f in os.listdir(raw_image_dir)]
+segmented_image_dir = "images/segmented"
 
-# segmenting parasite images to extract individual parasites
-for image_file in raw_image_files:
-    # load image
-    parasites = ski.io.imread(image_file)
-    parasites = 255 - parasites
+# size thresholds for individual parasites (pixel area)
+min_size = 200
+max_size = 7000
+
+# number of worker processes - adjust for the machine
+workers = os.cpu_count()
+
+STAGES = ("read", "threshold", "edt", "peaks", "watershed", "filter", "crop", "save")
+
+# segments one raw image, returns the number of parasites saved and the time spent in each stage
+def segment_image(image_file, output_dir=segmented_image_dir, min_size=200, max_size=7000):
+    timings = {}
+    start_time = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start_time
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0.0) + now - start_time
+        start_time = now
+
+    # load image once, keep the original for cropping
+    original_img = ski.io.imread(image_file)
+    parasites = 255 - original_img
 
     # convert to grayscale [0,255]
     parasites = ski.color.rgb2gray(parasites)
     parasites = (parasites * 255).astype(np.uint8)
+    lap("read")
 
     # apply Otsu threshold
     thresh = threshold_otsu(parasites)
     binary = parasites > thresh
+    lap("threshold")
 
     # distance transform
     distance = ndi.distance_transform_edt(binary)
+    lap("edt")
 
-    # Gaussian smoothing
+    # Gaussian smoothing, then one marker per parasite object
     distance_smooth = gaussian(distance, sigma=1)
-
-    # find markers for each parasite object
     coords = peak_local_max(distance_smooth, labels=binary, min_distance=40)
     markers = np.zeros_like(distance_smooth, dtype=int)
-    for i, (y, x) in enumerate(coords, 1):
-        markers[y, x] = i
-    
+    markers[coords[:, 0], coords[:, 1]] = np.arange(1, len(coords) + 1)
+    lap("peaks")
+
     # apply watershed for labels
-    lables = watershed(-distance_smooth, markers, mask=binary)
+    labels = watershed(-distance_smooth, markers, mask=binary)
+    lap("watershed")
 
-    # remove small/large objects based on size thresholds
-    min_size = 200
-    max_size = 7000
-    filtered_labels = np.zeros_like(lables)
+    # remove small/large objects based on size thresholds with a label lookup table
+    areas = np.bincount(labels.ravel())
+    keep = (areas >= min_size) & (areas <= max_size)
+    keep[0] = False
+    label_lut = np.where(keep, np.arange(len(areas)), 0)
+    filtered_labels = label_lut[labels]
+    lap("filter")
 
-    for region in regionprops(lables):
-        if min_size <= region.area <= max_size:
-            filtered_labels[lables == region.label] = region.label
+    # mask and crop each parasite within its bounding box, on a white background
+    base_name = os.path.basename(image_file).split('.')[0]
+    crops = []
+    for label, bbox in enumerate(ndi.find_objects(filtered_labels), 1):
+        if bbox is None:
+            continue
+        parasite_cropped_img = np.full(original_img[bbox].shape, 255, dtype=np.uint8)
+        mask = filtered_labels[bbox] == label
+        parasite_cropped_img[mask] = original_img[bbox][mask]
+        crops.append((f"parasite_{base_name}_{label}.png", parasite_cropped_img))
+    lap("crop")
 
-    # apply masks to original image to get individual parasites
-    original_img = ski.io.imread(image_file)
-    for region in regionprops(filtered_labels):
-        # white background
-        mask_img = np.ones_like(original_img, dtype=np.uint8) * 255
+    # save
+    for filename, parasite_cropped_img in crops:
+        ski.io.imsave(os.path.join(output_dir, filename), parasite_cropped_img)
+    lap("save")
+
+    return image_file, len(crops), timings
+
+def segment_task(args):
+    return segment_image(*args)
+
+def main():
+    raw_image_files = [os.path.join(raw_image_dir, f) for f in os.listdir(raw_image_dir)]
+    os.makedirs(segmented_image_dir, exist_ok=True)
+
+    # segmenting parasite images to extract individual parasites
+    tasks = [(image_file, segmented_image_dir, min_size, max_size) for image_file in raw_image_files]
+    total_timings = defaultdict(float)
+    total_parasites = 0
+
+    start_time = time.perf_counter()
+    if workers is None or workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(segment_task, tasks))
+    else:
+        results = [segment_task(task) for task in tasks]
+    end_time = time.perf_counter()
 
-        # mask
-        mask = filtered_labels == region.label
-        mask_img[mask] = original_img[mask]
+    for image_file, num_parasites, timings in results:
+        total_parasites += num_parasites
+        for stage, seconds in timings.items():
+            total_timings[stage] += seconds
+        stage_times = ", ".join(f"{stage}={timings[stage]:.3f}s" for stage in STAGES)
+        print(f"{image_file}: {num_parasites} parasites ({stage_times})")
 
-        # crop image
-        minr, minc, maxr, maxc = region.bbox
-        parasite_cropped_img = mask_img[minr:maxr, minc:maxc]
+    print(f"Segmented {total_parasites} parasites from {len(raw_image_files)} images in {end_time - start_time:.4f}s")
+    print("Total time per stage (summed over workers):")
+    for stage in STAGES:
+        print(f"    {stage}: {total_timings[stage]:.4f}s")
 
-        # save
-        filename = f"parasite_{os.path.basename(image_file).split('.')[0]}_{region.label}.png"
-        ski.io.imsave(os.path.join("images/segmented", filename), parasite_cropped_img)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
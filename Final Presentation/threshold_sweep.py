@@ -0,0 +1,103 @@
+import os
+import json
+
+import numpy as np
+
+from histogram_intersection import get_histogram_distance_matrix
+
+'''
+Vectorized precision/recall/F1 sweep over a grid of similarity radii r
+    - every query image's distance row is sorted once (in blocks of rows, so memory stays bounded)
+        - a cumulative sum over the sorted row counts the images of the query's own cluster
+        - searchsorted finds, for all radii at once, how many images lie within distance r
+        - precision, recall and F1 for every radius then follow from those two counts
+    - clusters are given as a label array over the collection (-1 for images in no cluster),
+      so no Python sets are built per query
+    - distance rows come from anything indexable by an array of row numbers
+        - a precomputed (memory-mapped) distance matrix from distance_matrix.py
+        - FeatureDistanceRows, which computes the rows from the feature store when no matrix is available
+    - returns full PR/F1 curves (averaged over every clustered image acting as query) for each cluster file
+'''
+
+# computes distance rows on demand from the color and LBP histogram matrices
+class FeatureDistanceRows:
+    def __init__(self, color_matrix, lbp_matrix, a=0.2, b=0.8):
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.a = a
+        self.b = b
+
+    def __getitem__(self, rows):
+        return get_histogram_distance_matrix(self.color_matrix[rows], self.color_matrix, self.lbp_matrix[rows], self.lbp_matrix,
+                                             a=self.a, b=self.b)
+
+# per-image cluster labels (-1 if unlisted) and the number of images listed in each cluster
+def get_cluster_labels(clusters, img_to_idx):
+    labels = np.full(len(img_to_idx), -1, dtype=np.int64)
+    sizes = np.zeros(len(clusters), dtype=np.int64)
+    for cluster_id, cluster in enumerate(clusters):
+        sizes[cluster_id] = len(set(clusters[cluster]))
+        for img in clusters[cluster]:
+            idx = img_to_idx.get(img)
+            if idx is not None:
+                labels[idx] = cluster_id
+    return labels, sizes
+
+# precision, recall and F1 of every query (rows) at every radius (columns)
+#   - retrieval is every image with distance <= r, relevance is membership in the query's cluster
+def sweep_thresholds(distance_rows, query_idx, labels, sizes, radii, block_size=256):
+    radii = np.asarray(radii, dtype=np.float64)
+    query_idx = np.asarray(query_idx, dtype=np.int64)
+    retrieved = np.empty((len(query_idx), len(radii)), dtype=np.int64)
+    true_positives = np.empty((len(query_idx), len(radii)), dtype=np.int64)
+
+    for start in range(0, len(query_idx), block_size):
+        rows = query_idx[start:start + block_size]
+        distances = np.asarray(distance_rows[rows])
+        order = np.argsort(distances, axis=1, kind="stable")
+        sorted_distances = np.take_along_axis(distances, order, axis=1)
+        # relevant_counts[i, j] is the number of same-cluster images among the j nearest of query i
+        relevant = labels[order] == labels[rows][:, None]
+        relevant_counts = np.zeros((len(rows), distances.shape[1] + 1), dtype=np.int64)
+        np.cumsum(relevant, axis=1, out=relevant_counts[:, 1:])
+
+        for i in range(len(rows)):
+            counts = np.searchsorted(sorted_distances[i], radii, side="right")
+            retrieved[start + i] = counts
+            true_positives[start + i] = relevant_counts[i, counts]
+
+    relevant_totals = sizes[labels[query_idx]][:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(retrieved > 0, true_positives / retrieved, 0.0)
+        recall = np.where(relevant_totals > 0, true_positives / relevant_totals, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return precision, recall, f1
+
+# average PR/F1 curves of one cluster file, every image listed in a cluster acts as a query
+def get_threshold_curves(distance_rows, clusters, img_to_idx, radii, block_size=256):
+    labels, sizes = get_cluster_labels(clusters, img_to_idx)
+    query_idx = [img_to_idx[img] for cluster in clusters for img in clusters[cluster] if img in img_to_idx]
+    precision, recall, f1 = sweep_thresholds(distance_rows, query_idx, labels, sizes, radii, block_size=block_size)
+    return {
+        "radii": np.asarray(radii, dtype=np.float64),
+        "precision": precision.mean(axis=0) if len(query_idx) else np.zeros(len(radii)),
+        "recall": recall.mean(axis=0) if len(query_idx) else np.zeros(len(radii)),
+        "f1": f1.mean(axis=0) if len(query_idx) else np.zeros(len(radii)),
+        "queries": len(query_idx),
+    }
+
+# (name, clusters) for every cluster file in cluster_dir, sorted by name
+def load_cluster_files(cluster_dir="clusters"):
+    cluster_files = []
+    for cluster_file in sorted(os.listdir(cluster_dir)):
+        if not cluster_file.endswith(".json"):
+            continue
+        with open(os.path.join(cluster_dir, cluster_file), "r") as f:
+            cluster_files.append((cluster_file[:-len(".json")], json.load(f)["clusters"]))
+    return cluster_files
+
+# writes {cluster file: curve} to a JSON file
+def write_curves(output_file, curves):
+    with open(output_file, "w") as f:
+        json.dump({name: {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in curve.items()}
+                   for name, curve in curves.items()}, f, indent=4)
@@ -1,78 +1,372 @@
+import os
+import json
+import heapq
+import time
+import shutil
+import tempfile
+
 import numpy as np
 
-from histogram_intersection import get_histogram_distance
+from histogram_intersection import get_histogram_distance, get_histogram_distances
+from sparse_histograms import SparseHistograms, choose_color_matrix
+from bound_cascade import BoundCascade, get_cascade_distances, new_counts
+
+'''
+VP tree stored as flat, parallel NumPy arrays
+    - nodes are numbered in preorder, so every left subtree sits directly after its parent
+    - pivot[node] is the row of the node's vantage point in the feature matrices (-1 for leaf buckets)
+    - mu[node] is the median pivot distance used to split the node (nan for leaf buckets)
+    - left[node] / right[node] are child node numbers (-1 if there is no child)
+    - subtrees of at most leaf_size images become leaf buckets
+        - a bucket owns the contiguous rows leaf_start[node]:leaf_end[node]
+        - buckets are scanned with one vectorized min-sum instead of one distance call per image
+        - with bound_cascade=True, buckets are scanned through the lower-bound cascade instead (see bound_cascade.py),
+          so only images that can be within the search radius get the full intersection
+        - leaf_size=1 gives the classic tree with single-image leaves
+    - the color and LBP features are copied into one matrix each, in tree order, for cache locality
+        - the color matrix is dense unless sparse=True (or sparse=None and the sparse kernel pays off for the leaf size),
+          see sparse_histograms.py; sparse leaves are not bit-identical to the dense distances
+        - splits (mu) are always computed from dense distances, the same kernel that scores pivots during search
+        - saved trees store it dense and load_vptree picks the form again
+    - index[row] maps a tree row back to its position in the input features
+    - search_vptree answers fixed-radius (tau) queries, knn_search_vptree answers k-nearest-neighbour queries
+    - a seed makes the random pivot choices (and so the tree and its comparison counts) reproducible
+    - save_vptree / load_vptree persist a built tree as .npy arrays plus a versioned meta.json
+        - meta.json records the feature store fingerprint the tree was built from
+        - each save goes to its own version directory, published by atomically replacing index_dir/CURRENT,
+          so several server workers can rebuild and save at once without deleting an index another one is reading
+        - load_vptree memory-maps the arrays and returns None when the saved tree is stale
+'''
+
+VPTREE_FORMAT_VERSION = 1
+VPTREE_ARRAYS = ("index", "color_matrix", "lbp_matrix", "pivot", "mu", "left", "right", "leaf_start", "leaf_end")
+# index_dir/CURRENT names the version directory (VPTREE_VERSION_PREFIX...) that holds the saved tree
+VPTREE_CURRENT_FILE = "CURRENT"
+VPTREE_VERSION_PREFIX = "version-"
+# unpublished or displaced version directories untouched for this long are deleted by the next save
+VPTREE_STALE_SECONDS = 600
 
-class VPNode:
-    def __init__(self, image_name=None, pivot_feature=None, mu=None, left=None, right=None, points=None):
-        self.image_name = image_name
-        self.pivot_feature = pivot_feature
+class VPTree:
+    def __init__(self, names, index, color_matrix, lbp_matrix, pivot, mu, left, right, leaf_start, leaf_end, leaf_size=1, seed=None, fingerprint=None, cascade=None):
+        self.names = names
+        self.index = index
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.pivot = pivot
         self.mu = mu
         self.left = left
         self.right = right
-        self.points = points
+        self.leaf_start = leaf_start
+        self.leaf_end = leaf_end
+        self.leaf_size = leaf_size
+        self.seed = seed
+        self.fingerprint = fingerprint
+        self.cascade = cascade
 
-def build_vptree(images_features):
+    def __len__(self):
+        return len(self.names)
+
+def build_vptree(images_features, leaf_size=1, seed=None, sparse=False, bound_cascade=False):
     if len(images_features) == 0:
         return None
-    if len(images_features) == 1:
-        name, feature = images_features[0]
-        return VPNode(image_name=name, pivot_feature=feature, points=[name])
-        
-    pivot_idx = np.random.randint(len(images_features))
-    pivot_name, pivot_feature = images_features[pivot_idx]
-
-    distances = []
-    for i, (name, feature) in enumerate(images_features):
-        if i != pivot_idx:
-            dist = get_histogram_distance(pivot_feature[0], feature[0], pivot_feature[1], feature[1], a=0.2, b=0.8)
-            distances.append((dist, name, feature))
-    
-    dists_only = [d[0] for d in distances]
-    mu = np.median(dists_only)
-    
-    left_points = [(name, feat) for d, name, feat in distances if d <= mu]
-    right_points = [(name, feat) for d, name, feat in distances if d > mu]
-    
-    left_tree = build_vptree(left_points)
-    right_tree = build_vptree(right_points)
-    
-    return VPNode(image_name=pivot_name,
-                  pivot_feature=pivot_feature,
-                  mu=mu,
-                  left=left_tree,
-                  right=right_tree,
-                  points=[name for name, _ in images_features]
+
+    names = [name for name, _ in images_features]
+    color_matrix = np.ascontiguousarray([feature[0] for _, feature in images_features], dtype=np.float32)
+    lbp_matrix = np.ascontiguousarray([feature[1] for _, feature in images_features], dtype=np.float64)
+    return build_vptree_from_matrix(names, color_matrix, lbp_matrix, leaf_size=leaf_size, seed=seed, sparse=sparse, bound_cascade=bound_cascade)
+
+def build_vptree_from_matrix(names, color_matrix, lbp_matrix, leaf_size=1, seed=None, sparse=False, bound_cascade=False):
+    if leaf_size < 1:
+        raise ValueError("leaf_size must be at least 1")
+    if len(names) == 0:
+        return None
+    if isinstance(color_matrix, SparseHistograms):
+        color_matrix = color_matrix.toarray()
+
+    # without a seed pivots come from the global NumPy generator, as before
+    rng = np.random.RandomState(seed) if seed is not None else np.random
+
+    order = []
+    pivot = []
+    mu = []
+    left = []
+    right = []
+    leaf_start = []
+    leaf_end = []
+
+    # each entry is (input indices of the subtree, parent node, side of the parent it hangs off)
+    stack = [(np.arange(len(names)), -1, None)]
+    while stack:
+        indices, parent, side = stack.pop()
+        node = len(mu)
+        if parent >= 0:
+            side[parent] = node
+        left.append(-1)
+        right.append(-1)
+
+        # small subtrees are stored as one contiguous bucket
+        if len(indices) <= leaf_size:
+            pivot.append(-1)
+            mu.append(np.nan)
+            leaf_start.append(len(order))
+            order.extend(indices)
+            leaf_end.append(len(order))
+            continue
+
+        pivot_pos = rng.randint(len(indices))
+        pivot_idx = indices[pivot_pos]
+        pivot.append(len(order))
+        order.append(pivot_idx)
+        mu.append(np.nan)
+        leaf_start.append(-1)
+        leaf_end.append(-1)
+
+        others = np.delete(indices, pivot_pos)
+        distances = get_histogram_distances(color_matrix[pivot_idx], color_matrix[others], lbp_matrix[pivot_idx], lbp_matrix[others], a=0.2, b=0.8)
+        mu[node] = np.median(distances)
+
+        left_points = others[distances <= mu[node]]
+        right_points = others[distances > mu[node]]
+
+        # left subtree is popped first so it is laid out right after this node
+        if len(right_points) > 0:
+            stack.append((right_points, node, right))
+        if len(left_points) > 0:
+            stack.append((left_points, node, left))
+
+    order = np.array(order, dtype=np.int64)
+    tree_color_matrix = choose_color_matrix(color_matrix[order], sparse=sparse, block_rows=leaf_size)
+    tree = VPTree(names=[names[i] for i in order],
+                  index=order,
+                  color_matrix=tree_color_matrix if isinstance(tree_color_matrix, SparseHistograms) else np.ascontiguousarray(tree_color_matrix),
+                  lbp_matrix=np.ascontiguousarray(lbp_matrix[order]),
+                  pivot=np.array(pivot, dtype=np.int64),
+                  mu=np.array(mu, dtype=np.float64),
+                  left=np.array(left, dtype=np.int64),
+                  right=np.array(right, dtype=np.int64),
+                  leaf_start=np.array(leaf_start, dtype=np.int64),
+                  leaf_end=np.array(leaf_end, dtype=np.int64),
+                  leaf_size=leaf_size,
+                  seed=seed
                   )
+    if bound_cascade:
+        tree.cascade = BoundCascade(tree.color_matrix, tree.lbp_matrix)
+    return tree
+
+# saves a built tree to index_dir, tagged with the fingerprint of the features it was built from
+#   - every save writes a fresh version directory inside index_dir (unique per call, so concurrent savers never share one)
+#     and then atomically replaces the CURRENT file that names it, so readers see either the old tree or the new one
+#   - the version CURRENT named before the swap is deleted afterwards, readers that already loaded it keep their memory maps
+#     and readers that were still opening it retry with the new one
+def save_vptree(tree, index_dir, fingerprint=None):
+    os.makedirs(index_dir, exist_ok=True)
+    version_dir = tempfile.mkdtemp(prefix=VPTREE_VERSION_PREFIX, dir=index_dir)
+
+    for name in VPTREE_ARRAYS:
+        array = getattr(tree, name)
+        np.save(os.path.join(version_dir, f"{name}.npy"), array.toarray() if isinstance(array, SparseHistograms) else np.asarray(array))
+
+    meta = {
+        "format": "vptree",
+        "version": VPTREE_FORMAT_VERSION,
+        "fingerprint": fingerprint,
+        "leaf_size": tree.leaf_size,
+        "seed": tree.seed,
+        "size": len(tree),
+        "names": list(tree.names),
+    }
+    with open(os.path.join(version_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
 
-def search_vptree(root, query_feature, tau):
-    if root is None:
-        return []
+    # swap the finished version in, so readers never see a half-written one
+    previous = get_current_version(index_dir)
+    fd, tmp_current = tempfile.mkstemp(prefix="CURRENT.", suffix=".tmp", dir=index_dir)
+    with os.fdopen(fd, "w") as f:
+        f.write(os.path.basename(version_dir))
+    os.replace(tmp_current, os.path.join(index_dir, VPTREE_CURRENT_FILE))
+    tree.fingerprint = fingerprint
+
+    if previous is not None and previous != os.path.basename(version_dir):
+        shutil.rmtree(os.path.join(index_dir, previous), ignore_errors=True)
+    # versions displaced by concurrent saves, old enough that no save is still writing them
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if name.startswith(VPTREE_VERSION_PREFIX) and name != os.path.basename(version_dir):
+            try:
+                if time.time() - os.path.getmtime(path) > VPTREE_STALE_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+    # files of the older single-directory layout
+    for name in ("meta.json",) + tuple(f"{name}.npy" for name in VPTREE_ARRAYS):
+        if os.path.exists(os.path.join(index_dir, name)):
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                pass
+
+# the version directory named by index_dir/CURRENT, or None if there is none
+def get_current_version(index_dir):
+    try:
+        with open(os.path.join(index_dir, VPTREE_CURRENT_FILE), "r") as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    return version or None
+
+# loads a saved tree with its arrays memory-mapped
+#   - returns None if there is no index, it was written by another format version,
+#     it was built from features other than the given fingerprint, or it was deleted while being read with no newer version
+#   - indexes saved before CURRENT existed (arrays directly in index_dir) are still read
+#   - the color matrix is converted to sparse form if sparse is True, or if sparse is None and it pays off (see build_vptree_from_matrix)
+#   - bound_cascade=True rebuilds the coarse color matrices of the cascade (they are not saved)
+def load_vptree(index_dir, fingerprint=None, sparse=False, bound_cascade=False):
+    version = get_current_version(index_dir)
+    while True:
+        tree_dir = index_dir if version is None else os.path.join(index_dir, version)
+        try:
+            with open(os.path.join(tree_dir, "meta.json"), "r") as f:
+                meta = json.load(f)
+            if meta.get("format") != "vptree" or meta.get("version") != VPTREE_FORMAT_VERSION:
+                return None
+            if fingerprint is not None and meta.get("fingerprint") != fingerprint:
+                return None
+            arrays = {name: np.asarray(np.load(os.path.join(tree_dir, f"{name}.npy"), mmap_mode="r")) for name in VPTREE_ARRAYS}
+            break
+        except OSError:
+            # a newer save replaced this version while it was being read, read that one instead
+            latest = get_current_version(index_dir)
+            if latest is None or latest == version:
+                return None
+            version = latest
+
+    arrays["color_matrix"] = choose_color_matrix(arrays["color_matrix"], sparse=sparse, block_rows=meta["leaf_size"])
+    tree = VPTree(names=meta["names"], leaf_size=meta["leaf_size"], seed=meta["seed"], fingerprint=meta["fingerprint"], **arrays)
+    if bound_cascade:
+        tree.cascade = BoundCascade(tree.color_matrix, tree.lbp_matrix)
+    return tree
+
+# distances from the query to every image in a leaf bucket, returns (first row, distances, exact distance evaluations)
+#   - through the cascade, images whose lower bound is beyond limit get an infinite distance without a full evaluation
+def scan_leaf(tree, node, query_feature, limit=np.inf, cascade_query=None, counts=None):
+    start, end = tree.leaf_start[node], tree.leaf_end[node]
+    if tree.cascade is not None:
+        exact = counts["exact"]
+        distances = get_cascade_distances(tree.cascade, cascade_query, start, end, limit=limit, counts=counts)
+        return start, distances, counts["exact"] - exact
+    distances = get_histogram_distances(query_feature[0], tree.color_matrix[start:end], query_feature[1], tree.lbp_matrix[start:end], a=0.2, b=0.8)
+    return start, distances, len(distances)
+
+# the cascade's prepared query and per-query counts, (None, None) for trees without a cascade
+def start_cascade(tree, query_feature):
+    if tree.cascade is None:
+        return None, None
+    return tree.cascade.prepare_query(query_feature), new_counts()
+
+def search_vptree(tree, query_feature, tau):
+    if tree is None:
+        return ([], 0)
 
     comparisons = 0
     fetched_relevant_images = []
-    stack = [root]
+    stack = [0]
+    cascade_query, counts = start_cascade(tree, query_feature)
 
     while stack:
         node = stack.pop()
-        if node is None:
+        row = tree.pivot[node]
+
+        if row < 0:
+            start, distances, evaluations = scan_leaf(tree, node, query_feature, tau, cascade_query, counts)
+            comparisons += evaluations
+            for offset in np.flatnonzero(distances <= tau):
+                fetched_relevant_images.append((tree.names[start + offset], distances[offset]))
             continue
 
-        dist = get_histogram_distance(node.pivot_feature[0], query_feature[0], node.pivot_feature[1], query_feature[1], a=0.2, b=0.8)
+        dist = get_histogram_distance(tree.color_matrix[row], query_feature[0], tree.lbp_matrix[row], query_feature[1], a=0.2, b=0.8)
         comparisons += 1
 
         if dist <= tau:
-            fetched_relevant_images.append((node.image_name, dist))
+            fetched_relevant_images.append((tree.names[row], dist))
 
-        if node.left is None and node.right is None:
+        left, right = tree.left[node], tree.right[node]
+        if left < 0 and right < 0:
             continue
 
-        if dist < node.mu:
-            stack.append(node.left)
-            if dist + tau >= node.mu:
-                stack.append(node.right)
+        mu = tree.mu[node]
+        if dist < mu:
+            if left >= 0:
+                stack.append(left)
+            if dist + tau >= mu and right >= 0:
+                stack.append(right)
         else:
-            stack.append(node.right)
-            if dist - tau <= node.mu:
-                stack.append(node.left)
+            if right >= 0:
+                stack.append(right)
+            if dist - tau <= mu and left >= 0:
+                stack.append(left)
+
+    if counts is not None:
+        tree.cascade.record(counts)
+    return (fetched_relevant_images, comparisons)
+
+# keeps the k closest rows in a max-heap and returns the (possibly shrunk) search radius
+def push_nearest(nearest, k, dist, row, radius):
+    if dist > radius:
+        return radius
+    if len(nearest) < k:
+        heapq.heappush(nearest, (-dist, row))
+    elif dist < -nearest[0][0]:
+        heapq.heapreplace(nearest, (-dist, row))
+    if len(nearest) == k:
+        radius = min(radius, -nearest[0][0])
+    return radius
+
+# best-first k-nearest-neighbour search
+#   - nodes are visited in order of the lower bound on the distance to anything in their subtree
+#   - the search radius shrinks to the current k-th best distance as closer images are found
+#   - stops once the closest unvisited bound is beyond the radius
+#   - an optional tau caps the radius, so at most k images within tau are returned
+def knn_search_vptree(tree, query_feature, k, tau=None):
+    if tree is None or k <= 0:
+        return ([], 0)
+
+    comparisons = 0
+    radius = np.inf if tau is None else tau
+    nearest = []  # max-heap of (-distance, row) holding the best k so far
+    queue = [(0.0, 0)]  # min-heap of (lower bound, node)
+    cascade_query, counts = start_cascade(tree, query_feature)
+
+    while queue:
+        bound, node = heapq.heappop(queue)
+        if bound > radius:
+            break
+
+        row = tree.pivot[node]
+        if row < 0:
+            start, distances, evaluations = scan_leaf(tree, node, query_feature, radius, cascade_query, counts)
+            comparisons += evaluations
+            for offset in np.flatnonzero(distances <= radius):
+                radius = push_nearest(nearest, k, distances[offset], start + offset, radius)
+            continue
+
+        dist = get_histogram_distance(tree.color_matrix[row], query_feature[0], tree.lbp_matrix[row], query_feature[1], a=0.2, b=0.8)
+        comparisons += 1
+
+        radius = push_nearest(nearest, k, dist, row, radius)
+
+        # triangle inequality: inside the ball d(q, x) >= dist - mu, outside it d(q, x) >= mu - dist
+        mu = tree.mu[node]
+        left, right = tree.left[node], tree.right[node]
+        if left >= 0:
+            left_bound = max(bound, dist - mu)
+            if left_bound <= radius:
+                heapq.heappush(queue, (left_bound, left))
+        if right >= 0:
+            right_bound = max(bound, mu - dist)
+            if right_bound <= radius:
+                heapq.heappush(queue, (right_bound, right))
 
-    return (fetched_relevant_images, comparisons)
\ No newline at end of file
+    if counts is not None:
+        tree.cascade.record(counts)
+    fetched_relevant_images = sorted(((tree.names[row], -neg_dist) for neg_dist, row in nearest), key=lambda x: x[1])
+    return (fetched_relevant_images, comparisons)
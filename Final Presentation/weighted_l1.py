@@ -0,0 +1,145 @@
+import numpy as np
+
+from histogram_intersection import get_histogram_distances
+from exhaustive import select_results
+from sparse_histograms import SparseHistograms
+
+'''
+Weighted-L1 embedding of (color_hist, lbp_hist) pairs, so standard L1 (manhattan / cityblock) indexes can search Final features
+    - for two histograms that sum to 1: min(x, y) = (x + y - |x - y|) / 2, so intersection = 1 - L1 / 2
+    - with a + b = 1 the distance becomes
+        1 - (a * I_color + b * I_lbp) = (a * L1(c1, c2) + b * L1(l1, l2)) / 2 = L1([a * c1, b * l1], [a * c2, b * l2]) / 2
+      so every image is embedded as the 538-dim vector [a * color_hist, b * lbp_hist] and tau <-> L1 radius is a factor of 2
+      (tau_to_l1 / l1_to_tau)
+    - stored float32 color histograms sum to 1 only up to rounding (about 4e-8), which shifts a distance from its L1 / 2
+      by at most half the sum of both rows' mass errors (get_mass_errors), plus DISTANCE_TOLERANCE for float rounding
+        - the L1 index only proposes candidates, widened by that slack, and get_histogram_distances rescores them,
+          so every decision is made on the exact distance and results match exhaustive search
+        - top-k takes the k-th L1 distance of the k nearest embedded rows, then every row within it (plus twice the slack)
+    - backends (build_weighted_l1_index(backend=...))
+        - "ball_tree": sklearn BallTree(metric="manhattan"), exact, comparisons are its distance calls plus the rescored rows
+        - "cdist": scipy cdist(metric="cityblock") against every row, exact, comparisons are N plus the rescored rows
+        - "annoy": AnnoyIndex(metric="manhattan"), approximate (its trees can miss neighbours), radius search asks for
+          twice as many neighbours until the farthest one is beyond the radius,
+          comparisons are the neighbours it returned plus the rescored rows
+        - each backend's library is imported only when that backend is used, so the embedding itself
+          (embed_features / embed_matrix, used by the IVF index) needs nothing beyond NumPy
+'''
+
+# slack on the L1 / 2 <-> distance identity for float rounding, in distance units
+DISTANCE_TOLERANCE = 1e-6
+L1_BACKENDS = ("ball_tree", "cdist", "annoy")
+
+def tau_to_l1(tau):
+    return 2 * tau
+
+def l1_to_tau(l1):
+    return l1 / 2
+
+# [a * color_hist, b * lbp_hist] of one image
+def embed_features(color_hist, lbp_hist, a=0.2, b=0.8):
+    return np.concatenate([np.asarray(color_hist, dtype=np.float64) * a, np.asarray(lbp_hist, dtype=np.float64) * b])
+
+# embeds every row of the feature matrices (dense, memory-mapped or SparseHistograms), chunk_size rows at a time
+def embed_matrix(color_matrix, lbp_matrix, a=0.2, b=0.8, chunk_size=65536):
+    n_color = color_matrix.shape[1]
+    out = np.empty((len(color_matrix), n_color + lbp_matrix.shape[1]))
+    for start in range(0, len(color_matrix), chunk_size):
+        color_chunk = color_matrix[start:start + chunk_size]
+        if isinstance(color_chunk, SparseHistograms):
+            color_chunk = color_chunk.toarray()
+        out[start:start + chunk_size, :n_color] = np.asarray(color_chunk, dtype=np.float64) * a
+        out[start:start + chunk_size, n_color:] = np.asarray(lbp_matrix[start:start + chunk_size], dtype=np.float64) * b
+    return out
+
+# |a * (1 - sum(color_hist)) + b * (1 - sum(lbp_hist))| of every embedded row
+def get_mass_errors(embedded):
+    return np.abs(1 - embedded.sum(axis=1))
+
+class WeightedL1Index:
+    def __init__(self, names, color_matrix, lbp_matrix, embedded, backend, backend_index, mass_error, a=0.2, b=0.8):
+        self.names = names
+        self.color_matrix = color_matrix
+        self.lbp_matrix = lbp_matrix
+        self.embedded = embedded
+        self.backend = backend
+        self.backend_index = backend_index
+        self.mass_error = mass_error
+        self.a = a
+        self.b = b
+
+    def __len__(self):
+        return len(self.names)
+
+def build_weighted_l1_index(names, color_matrix, lbp_matrix, backend="ball_tree", leaf_size=40, n_trees=10, a=0.2, b=0.8):
+    if backend not in L1_BACKENDS:
+        raise ValueError(f"unknown L1 backend {backend!r}, expected one of {L1_BACKENDS}")
+    embedded = embed_matrix(color_matrix, lbp_matrix, a=a, b=b)
+    backend_index = None
+    if backend == "ball_tree" and len(embedded):
+        from sklearn.neighbors import BallTree
+        backend_index = BallTree(embedded, metric="manhattan", leaf_size=leaf_size)
+    elif backend == "annoy":
+        from annoy import AnnoyIndex
+        backend_index = AnnoyIndex(embedded.shape[1], metric="manhattan")
+        for i, row in enumerate(embedded):
+            backend_index.add_item(i, row)
+        backend_index.build(n_trees)
+    mass_error = get_mass_errors(embedded).max() if len(embedded) else 0.0
+    return WeightedL1Index(list(names), color_matrix, lbp_matrix, embedded, backend, backend_index, mass_error, a=a, b=b)
+
+# rows within L1 radius r of the embedded query (ball tree or annoy), returns (rows, L1 distance evaluations)
+def get_l1_radius_rows(index, embedded_query, r):
+    if index.backend == "ball_tree":
+        index.backend_index.reset_n_calls()
+        rows = index.backend_index.query_radius(embedded_query[None, :], r=r)[0]
+        return rows, index.backend_index.get_n_calls()
+    n = 1
+    while True:
+        n = min(2 * n, len(index))
+        rows, l1 = index.backend_index.get_nns_by_vector(embedded_query, n, include_distances=True)
+        if n == len(index) or l1[-1] > r:
+            break
+    rows, l1 = np.array(rows, dtype=np.int64), np.array(l1)
+    return rows[l1 <= r], len(rows)
+
+# L1 distance from the embedded query to its k-th nearest row (ball tree or annoy), returns (distance, L1 distance evaluations)
+def get_l1_kth_distance(index, embedded_query, k):
+    k = min(k, len(index))
+    if index.backend == "ball_tree":
+        index.backend_index.reset_n_calls()
+        l1 = index.backend_index.query(embedded_query[None, :], k=k)[0][0]
+        return l1[-1], index.backend_index.get_n_calls()
+    l1 = index.backend_index.get_nns_by_vector(embedded_query, k, include_distances=True)[1]
+    return l1[-1], len(l1)
+
+def search_weighted_l1_index(index, query_feature, tau=None, k=None):
+    if len(index) == 0 or (k is not None and k <= 0):
+        return ([], 0)
+    color_hist, lbp_hist = query_feature
+    embedded_query = embed_features(color_hist, lbp_hist, a=index.a, b=index.b)
+    # the most any distance can differ from its L1 / 2, for this query against any row
+    slack = (get_mass_errors(embedded_query[None, :])[0] + index.mass_error) / 2 + DISTANCE_TOLERANCE
+
+    r = np.inf if tau is None else tau_to_l1(tau + slack)
+    # the k-th exact distance is at most l1_to_tau(kth) + slack, and any row within that is within kth + 4 * slack in L1
+    if index.backend == "cdist":
+        from scipy.spatial.distance import cdist
+        l1 = cdist(embedded_query[None, :], index.embedded, metric="cityblock")[0]
+        if k is not None:
+            kth = np.partition(l1, min(k, len(index)) - 1)[min(k, len(index)) - 1]
+            r = min(r, kth + tau_to_l1(2 * slack))
+        rows, comparisons = np.flatnonzero(l1 <= r), len(index)
+    else:
+        comparisons = 0
+        if k is not None:
+            kth, comparisons = get_l1_kth_distance(index, embedded_query, k)
+            r = min(r, kth + tau_to_l1(2 * slack))
+        rows, evaluations = get_l1_radius_rows(index, embedded_query, r)
+        comparisons += evaluations
+
+    rows = np.sort(rows)
+    distances = np.full(len(index), np.inf)
+    distances[rows] = get_histogram_distances(color_hist, index.color_matrix[rows], lbp_hist, index.lbp_matrix[rows], a=index.a, b=index.b)
+    fetched_relevant_images, _ = select_results(index.names, distances, tau, k)
+    return fetched_relevant_images, comparisons + len(rows)